@@ -2,25 +2,43 @@
 :copyright: (c) 2014 Building Energy Inc
 :license: see LICENSE for more details.
 """
-import dateutil
+from collections import OrderedDict
+import dateutil.parser
 from datetime import datetime, date
 import re
 import string
+import threading
 
-from mcm.matchers import fuzzy_in_set
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+from mcm.matchers import fuzzy_in_set, SynonymSet
 
 
 NONE_SYNONYMS = (u'not available', u'not applicable', u'n/a')
 BOOL_SYNONYMS = (u'true', u'yes', u'y', u'1')
+# Staged, memoized equivalents of ``fuzzy_in_set(value, *_SYNONYMS)``.
+NONE_SYNONYM_SET = SynonymSet(NONE_SYNONYMS)
+BOOL_SYNONYM_SET = SynonymSet(BOOL_SYNONYMS)
 PUNCT_REGEX = re.compile('[{0}]'.format(
     re.escape(string.punctuation.replace('.', '')))
 )
+# How many distinct values each memoized cleaner remembers by default.
+MEMO_SIZE = 10000
+# numpy dtype of columns of each type found in an ontology's ``types``;
+# columns of any other type are arrays of objects.
+ARRAY_DTYPES = {
+    u'float': 'float64',
+    u'date': 'datetime64[us]',
+}
 
 
 def default_cleaner(value, *args):
     """Pass-through validation for strings we don't know about."""
     if isinstance(value, unicode):
-        if fuzzy_in_set(value.lower(), NONE_SYNONYMS):
+        if value.lower() in NONE_SYNONYM_SET:
             return None
     return value
 
@@ -63,7 +81,7 @@ def bool_cleaner(value, *args):
     if isinstance(value, bool):
         return value
 
-    if fuzzy_in_set(value.strip().lower(), BOOL_SYNONYMS):
+    if value.strip().lower() in BOOL_SYNONYM_SET:
         return True
     else:
         return False
@@ -97,9 +115,290 @@ def date_cleaner(value, *args):
     return value
 
 
+def clean_column(values, cleaner):
+    """Clean a whole column of values, running cleaner once per distinct one.
+
+    Values of different types are cleaned apart, as with ``MemoizedCleaner``;
+    unhashable ones are simply cleaned every time.
+    Usage:
+            clean_column([u'1,000', u'N/A', u'1,000'], float_cleaner)
+            # [1000.0, None, 1000.0]
+
+    :param values: list of raw values, e.g. one column of a batch of rows.
+    :param cleaner: callable, cleans a single value.
+    :rtype: list of cleaned values, in the same order.
+
+    """
+    # Columns of a single type, as read from CSV files, can't mix up equal
+    # values of different types, e.g. 1 and 1.0, so they needn't be keyed
+    # on type.
+    if len(set(map(type, values))) == 1:
+        try:
+            distinct = set(values)
+        except TypeError:
+            pass
+        else:
+            results = dict((value, cleaner(value)) for value in distinct)
+            return map(results.__getitem__, values)
+
+    results = {}
+    cleaned = []
+    append = cleaned.append
+    for value in values:
+        key = (type(value), value)
+        try:
+            result = results[key]
+        except KeyError:
+            result = results[key] = cleaner(value)
+        except TypeError:
+            result = cleaner(value)
+        append(result)
+
+    return cleaned
+
+
+def column_array(values, column_type=None):
+    """A numpy array of a column's cleaned values, typed by its column_type.
+
+    Floats are float64, with None as nan; dates are datetime64, with None
+    as NaT. Everything else is kept as is in an array of objects.
+    Usage:
+            column_array([1000.0, None], u'float')
+            # array([ 1000.,    nan])
+
+    :param values: list of cleaned values, e.g. from ``clean_column``.
+    :param column_type: (optional) str, the column's type in the ontology.
+    :rtype: numpy.ndarray
+
+    """
+    if numpy is None:
+        raise ImportError('column_array needs numpy')
+
+    dtype = ARRAY_DTYPES.get(column_type)
+    if dtype is not None:
+        return numpy.array(values, dtype=dtype)
+
+    array = numpy.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+class DateParser(object):
+    """``date_cleaner`` for a single column, which learns the column's
+    dominant date format and parses values in it without dateutil.
+
+    The first ``sample_size`` values go through ``date_cleaner`` while we
+    watch which of ``DATE_FORMATS`` they're written in. If one of them
+    covers most of the sample, later values matching it are built straight
+    from the regex groups. Anything else, including values which match but
+    aren't real dates, still falls back to ``date_cleaner``, so the results
+    never differ from it.
+    Usage:
+            clean_date = DateParser()
+            for value in column_values:
+                clean_date(value)
+            clean_date.format  # u'mdy', say
+
+    """
+    # Name for memo stats; every column's parser reports as date cleaning.
+    __name__ = 'date_cleaner'
+
+    # (name, regex) for formats dateutil reads the same way. Years are four
+    # digits from 1000 up, as dateutil treats smaller ones as two digit years.
+    DATE_FORMATS = (
+        (u'mdy', re.compile(
+            r'^(?P<month>\d{1,2})/(?P<day>\d{1,2})/(?P<year>[1-9]\d{3})$'
+        )),
+        (u'mdy_time', re.compile(
+            r'^(?P<month>\d{1,2})/(?P<day>\d{1,2})/(?P<year>[1-9]\d{3}) '
+            r'(?P<hour>\d{1,2}):(?P<minute>\d{2})(?::(?P<second>\d{2}))?$'
+        )),
+        (u'mdy_dash', re.compile(
+            r'^(?P<month>\d{1,2})-(?P<day>\d{1,2})-(?P<year>[1-9]\d{3})$'
+        )),
+        (u'ymd', re.compile(
+            r'^(?P<year>[1-9]\d{3})-(?P<month>\d{1,2})-(?P<day>\d{1,2})$'
+        )),
+        (u'ymd_time', re.compile(
+            r'^(?P<year>[1-9]\d{3})-(?P<month>\d{1,2})-(?P<day>\d{1,2})'
+            r'[T ](?P<hour>\d{1,2}):(?P<minute>\d{2})'
+            r'(?::(?P<second>\d{2}))?$'
+        )),
+        (u'ymd_slash', re.compile(
+            r'^(?P<year>[1-9]\d{3})/(?P<month>\d{1,2})/(?P<day>\d{1,2})$'
+        )),
+    )
+
+    def __init__(self, sample_size=32, formats=None):
+        self.sample_size = sample_size
+        self.formats = formats or self.DATE_FORMATS
+        self.format = None
+        self._regex = None
+        self._sample = []
+        # Columns may be cleaned from several threads at once.
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def infer(self, values):
+        """Pick the format most of values are in, if there is one.
+
+        :param values: iterable of raw values, e.g. the start of a column.
+        :returns: the name of the format chosen, or None.
+
+        """
+        strings = [
+            value.strip() for value in values
+            if value and isinstance(value, basestring)
+        ]
+        best, best_count = None, 0
+        for name, regex in self.formats:
+            count = sum(1 for value in strings if regex.match(value))
+            if count > best_count:
+                best, best_count = (name, regex), count
+
+        chosen = (None, None)
+        # Only commit to a format most of the column is written in.
+        if best is not None and best_count * 2 > len(strings):
+            chosen = best
+        self.format, self._regex = chosen
+
+        return self.format
+
+    def __call__(self, value, *args):
+        if self._regex is not None and isinstance(value, basestring):
+            match = self._regex.match(value.strip())
+            if match is not None:
+                parts = match.groupdict()
+                try:
+                    return datetime(
+                        int(parts['year']),
+                        int(parts['month']),
+                        int(parts['day']),
+                        int(parts.get('hour') or 0),
+                        int(parts.get('minute') or 0),
+                        int(parts.get('second') or 0),
+                    )
+                except ValueError:
+                    # Let dateutil decide, e.g. it swaps day and month.
+                    pass
+
+        elif self._sample is not None:
+            with self._lock:
+                # Another thread may have finished the sample meanwhile.
+                if self._sample is not None:
+                    self._sample.append(value)
+                    if len(self._sample) >= self.sample_size:
+                        self.infer(self._sample)
+                        self._sample = None
+
+        return date_cleaner(value)
+
+
+class MemoizedCleaner(object):
+    """Wraps a cleaning function, remembering the results for the most
+    recently seen values.
+
+    Values of different types are remembered apart, so ``1``, ``1.0`` and
+    ``u'1'`` never share a result. Calls with unhashable arguments, e.g. a
+    list of enum choices, are passed straight through.
+    Usage:
+            clean_date = MemoizedCleaner(date_cleaner, max_size=1000)
+            clean_date(u'2/12/2012')  # parsed
+            clean_date(u'2/12/2012')  # remembered
+            clean_date.stats()
+
+    """
+    def __init__(self, func, max_size=MEMO_SIZE):
+        self.func = func
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+        # Shared by every thread cleaning with this memo.
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._results)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __call__(self, value, *args):
+        key = (type(value), value, args)
+        try:
+            hash(key)
+        except TypeError:
+            return self.func(value, *args)
+
+        results = self._results
+        with self._lock:
+            try:
+                result = results.pop(key)
+            except KeyError:
+                self.misses += 1
+            else:
+                self.hits += 1
+                results[key] = result
+                return result
+
+        # Cleaned outside the lock; at worst two threads clean a value twice.
+        result = self.func(value, *args)
+        with self._lock:
+            results.pop(key, None)
+            while results and len(results) >= self.max_size:
+                results.popitem(last=False)
+            results[key] = result
+
+        return result
+
+    def clear(self):
+        """Forget every remembered value and reset the counters."""
+        with self._lock:
+            self._results.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """Hit and miss counts, with size and hit rate."""
+        calls = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._results),
+            'hit_rate': float(self.hits) / calls if calls else 0.0,
+        }
+
+
 class Cleaner(object):
-    """Cleans values for a given ontology."""
-    def __init__(self, ontology):
+    """Cleans values for a given ontology.
+
+    :param ontology: dict, with column name -> type under ``types``.
+    :param memo_size: (optional) int, how many distinct values each kind of
+        cleaning remembers the results for. 0 or None turns it off.
+    :param infer_dates: (optional) bool, give each date column a
+        ``DateParser`` which learns its format. Defaults to True.
+
+    """
+    # Cleaning functions for each type found in an ontology's ``types``.
+    type_cleaners = {
+        u'float': float_cleaner,
+        u'date': date_cleaner,
+    }
+
+    def __init__(self, ontology, memo_size=MEMO_SIZE, infer_dates=True):
         self.ontology = ontology
         self.schema = self.ontology.get(u'types', {})
         self.float_columns = filter(
@@ -108,14 +407,156 @@ class Cleaner(object):
         self.date_columns = filter(
             lambda x: self.schema[x] == u'date', self.schema
         )
+        self.float_column_set = frozenset(self.float_columns)
+        self.date_column_set = frozenset(self.date_columns)
+        self.memo_size = memo_size
+        # cleaning function -> its MemoizedCleaner, one shared per instance.
+        self.memos = {}
+        self.default_cleaner = self.memoize(default_cleaner)
+        # column name -> function to run after ``default_cleaner``.
+        self.column_cleaners = dict(
+            (column, self.memoize(self.type_cleaners[column_type]))
+            for column, column_type in self.schema.items()
+            if column_type in self.type_cleaners
+        )
+        if infer_dates:
+            # Each date column gets to learn its own format.
+            for column in self.date_columns:
+                self.column_cleaners[column] = self.memoize(DateParser())
+
+    def memoize(self, func):
+        """Return func, remembering its results if this Cleaner memoizes.
+
+        Use it for any other cleaners run during the same import, e.g.
+        ``cleaner.memoize(bool_cleaner)``.
+
+        """
+        if not self.memo_size:
+            return func
+        if func not in self.memos:
+            self.memos[func] = MemoizedCleaner(func, max_size=self.memo_size)
+
+        return self.memos[func]
+
+    def memo_stats(self):
+        """Stats for each memoized cleaner, by cleaning function name.
+
+        Memos of cleaners sharing a name, e.g. each column's ``DateParser``,
+        are added up together.
+
+        """
+        stats = {}
+        for func, memo in self.memos.items():
+            totals = stats.setdefault(
+                func.__name__, {'hits': 0, 'misses': 0, 'size': 0}
+            )
+            for key, value in memo.stats().items():
+                if key in totals:
+                    totals[key] += value
+
+        for totals in stats.values():
+            calls = totals['hits'] + totals['misses']
+            totals['hit_rate'] = (
+                float(totals['hits']) / calls if calls else 0.0
+            )
+
+        return stats
+
+    def date_formats(self):
+        """The format each date column's ``DateParser`` settled on."""
+        return dict(
+            (column, getattr(cleaner, 'func', cleaner).format)
+            for column, cleaner in self.column_cleaners.items()
+            if isinstance(getattr(cleaner, 'func', cleaner), DateParser)
+        )
 
     def clean_value(self, value, column_name):
         """Clean the value, based on characteristics of its column_name."""
-        value = default_cleaner(value)
-        if column_name in self.float_columns:
-            return float_cleaner(value)
-
-        if column_name in self.date_columns:
-            return date_cleaner(value)
+        value = self.default_cleaner(value)
+        cleaner = self.column_cleaners.get(column_name)
+        if cleaner is not None:
+            return cleaner(value)
 
         return value
+
+    def clean_row(self, row):
+        """Clean every value in row, a dict of column name -> value.
+
+        :returns: dict, a new row of cleaned values.
+
+        """
+        clean_default = self.default_cleaner
+        cleaners = self.column_cleaners
+        cleaned = {}
+        for column_name, value in row.items():
+            value = clean_default(value)
+            cleaner = cleaners.get(column_name)
+            cleaned[column_name] = value if cleaner is None else cleaner(value)
+
+        return cleaned
+
+    def column_cleaner(self, column_name):
+        """The function ``clean_value`` runs on values of column_name."""
+        clean_default = self.default_cleaner
+        cleaner = self.column_cleaners.get(column_name)
+        if cleaner is None:
+            return clean_default
+
+        def clean(value):
+            return cleaner(clean_default(value))
+
+        return clean
+
+    def clean_column(self, values, column_name):
+        """Clean a list of values, all from column_name, in one go.
+
+        Each distinct value is only cleaned once per call, so this is much
+        cheaper than ``clean_value`` on each of them for repetitive columns.
+
+        :rtype: list, what ``clean_value`` would make of each value.
+
+        """
+        return clean_column(values, self.column_cleaner(column_name))
+
+    def clean_columns(self, columns, arrays=False):
+        """Clean a batch of rows held as columns.
+
+        :param columns: dict, column name -> list of that column's values,
+            e.g. from ``MCMParser.column_batches``.
+        :param arrays: (optional) bool, return float columns as numpy
+            float arrays, None becoming nan. Needs numpy.
+        :returns: dict, column name -> list of cleaned values.
+
+        """
+        if arrays and numpy is None:
+            raise ImportError('clean_columns needs numpy for arrays')
+
+        cleaned = {}
+        for column_name, values in columns.items():
+            values = self.clean_column(values, column_name)
+            if arrays and column_name in self.float_column_set:
+                values = column_array(values, u'float')
+            cleaned[column_name] = values
+
+        return cleaned
+
+    def clean_arrays(self, columns):
+        """Clean a batch of rows held as columns into numpy arrays.
+
+        Each column is typed by its type in the ontology; see
+        ``column_array``. Needs numpy.
+
+        :param columns: dict, column name -> list of that column's values.
+        :returns: dict, column name -> numpy array of cleaned values.
+
+        """
+        return dict(
+            (
+                column_name,
+                column_array(
+                    self.clean_column(values, column_name),
+                    self.schema.get(column_name),
+                )
+            )
+            for column_name, values in columns.items()
+        )
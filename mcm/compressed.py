@@ -0,0 +1,264 @@
+"""
+:copyright: (c) 2014 Building Energy Inc
+:license: see LICENSE for more details.
+
+
+Reads compressed files as they're decompressed.
+
+Nothing is decompressed to disk, or held in memory beyond a chunk at a
+time. ``StreamFile`` makes the decompressed bytes look enough like a file
+for the readers: it reads, reads lines and seeks, going back by starting
+the decompression over. Text files with byte order marks are read the same
+way, re-encoded as plain UTF-8.
+
+"""
+import bz2
+import codecs
+import zipfile
+import zlib
+
+from mcm.xlsx import FileView
+
+# How many bytes are read from a stream at a time.
+CHUNK_SIZE = 65536
+# How many compressed bytes are decompressed at a time. bz2 can't be made
+# to stop at a chunk of output, so this bounds how much a single call can
+# make of very highly compressed data.
+COMPRESSED_CHUNK_SIZE = 8192
+
+
+class StreamFile(object):
+    """A read only file of the bytes of a stream.
+
+    Seeking back opens the stream again with ``open_stream`` and reads up
+    to the offset; there's no seeking from the end, and no ``fileno``.
+
+    usage:
+            f = StreamFile(lambda: zip_file.open('data.csv'))
+            for line in f:
+                # something with the line
+            f.seek(0)  # opens data.csv again
+
+    :param open_stream: callable, returns a new stream with a ``read(size)``
+        method giving bytes from the start, and '' at the end.
+
+    """
+    def __init__(self, open_stream):
+        self._open_stream = open_stream
+        self._rewind()
+
+    def _rewind(self):
+        self._stream = self._open_stream()
+        self._buffer = ''
+        # position in the buffer, and in the stream of the buffer's start
+        self._pos = 0
+        self._offset = 0
+
+    def _fill(self):
+        """Read another chunk into the buffer, dropping what's been read.
+
+        :returns: bool, False at the end of the stream.
+
+        """
+        data = self._stream.read(CHUNK_SIZE)
+        if not data:
+            return False
+        self._offset += self._pos
+        self._buffer = self._buffer[self._pos:] + data
+        self._pos = 0
+        return True
+
+    def tell(self):
+        return self._offset + self._pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.tell()
+        elif whence != 0:
+            raise IOError('Streams can only seek from their start')
+        if offset < self._offset:
+            self._rewind()
+        while offset - self._offset > len(self._buffer):
+            self._pos = len(self._buffer)
+            if not self._fill():
+                break
+        self._pos = min(offset - self._offset, len(self._buffer))
+
+    def read(self, size=-1):
+        if size < 0:
+            chunks = [self._buffer[self._pos:]]
+            chunks.extend(iter(lambda: self._stream.read(CHUNK_SIZE), ''))
+            data = ''.join(chunks)
+            self._offset += self._pos + len(data)
+            self._buffer = ''
+            self._pos = 0
+            return data
+
+        while len(self._buffer) - self._pos < size and self._fill():
+            pass
+        data = self._buffer[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+    def readline(self):
+        # How far past our position the buffer has no newline.
+        scanned = 0
+        while 1:
+            end = self._buffer.find('\n', self._pos + scanned)
+            if end != -1:
+                end += 1
+                break
+            scanned = len(self._buffer) - self._pos
+            if not self._fill():
+                end = len(self._buffer)
+                break
+
+        line = self._buffer[self._pos:end]
+        self._pos = end
+        return line
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+
+class Decompressor(object):
+    """Stream of the decompressed bytes of the file f, from its start.
+
+    Files of several compressed streams one after another, e.g. from
+    ``pigz`` or ``pbzip2``, are decompressed as one.
+
+    :param f: file, of compressed bytes.
+    :param new_decompressor: callable, returns a decompressor object for a
+        single stream, e.g. ``bz2.BZ2Decompressor``.
+
+    """
+    def __init__(self, f, new_decompressor):
+        self.f = f
+        self.f.seek(0)
+        self._new_decompressor = new_decompressor
+        self._decompressor = new_decompressor()
+        # Compressed bytes read, but not decompressed yet.
+        self._tail = ''
+
+    def _decompress(self, data):
+        decompressed = []
+        # Padding after the last stream is ignored, as by ``gzip``.
+        while data.strip('\x00'):
+            decompressor = self._decompressor
+            try:
+                if hasattr(decompressor, 'unconsumed_tail'):
+                    # zlib can stop at a chunk of output, as highly
+                    # compressed data would otherwise swamp memory.
+                    decompressed.append(
+                        decompressor.decompress(data, CHUNK_SIZE)
+                    )
+                else:
+                    decompressed.append(decompressor.decompress(data))
+            except EOFError:
+                # bz2 streams refuse data after their end.
+                self._decompressor = self._new_decompressor()
+                continue
+            self._tail = getattr(decompressor, 'unconsumed_tail', '')
+            if self._tail:
+                break
+            # What followed the end of a stream starts another one.
+            data = decompressor.unused_data
+            if data.strip('\x00'):
+                self._decompressor = self._new_decompressor()
+
+        return ''.join(decompressed)
+
+    def read(self, size=None):
+        """Some more decompressed bytes, or '' at the end.
+
+        size is ignored; it's as much as the next chunk of compressed bytes
+        decompresses to.
+        """
+        while 1:
+            data = self._tail or self.f.read(COMPRESSED_CHUNK_SIZE)
+            if not data:
+                flush = getattr(self._decompressor, 'flush', None)
+                return flush() if flush is not None else ''
+            data = self._decompress(data)
+            if data:
+                return data
+
+
+class Recoder(object):
+    """Stream of the text file f, re-encoded as UTF-8, from its start.
+
+    Byte order marks are dropped, as decoding with 'utf-16' or 'utf-8-sig'
+    does.
+
+    :param f: file, of text in encoding.
+    :param encoding: str, the codec to decode f with.
+
+    """
+    def __init__(self, f, encoding):
+        self.f = f
+        self.f.seek(0)
+        self._decoder = codecs.getincrementaldecoder(encoding)()
+
+    def read(self, size=None):
+        """Some more re-encoded bytes, or '' at the end.
+
+        size is ignored; it's as much as the next chunk of f re-encodes to.
+        """
+        while 1:
+            data = self.f.read(COMPRESSED_CHUNK_SIZE)
+            text = self._decoder.decode(data, final=not data)
+            if text or not data:
+                return text.encode('utf-8')
+
+
+def _gzip_decompressor():
+    # 16 + MAX_WBITS expects, and skips, gzip's own header and trailer.
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def gzip_file(f):
+    """The decompressed bytes of the gzip file f, as a ``StreamFile``."""
+    return StreamFile(lambda: Decompressor(f, _gzip_decompressor))
+
+
+def bz2_file(f):
+    """The decompressed bytes of the bz2 file f, as a ``StreamFile``."""
+    return StreamFile(lambda: Decompressor(f, bz2.BZ2Decompressor))
+
+
+def utf8_file(f, encoding):
+    """The text file f, re-encoded from encoding as UTF-8, as a
+    ``StreamFile``."""
+    return StreamFile(lambda: Recoder(f, encoding))
+
+
+def zip_members(f):
+    """Names of the files in the zip archive f, in archive order.
+
+    Directories and Mac OS resource forks are left out.
+    """
+    return [
+        name for name in zipfile.ZipFile(FileView(f)).namelist()
+        if not name.endswith('/') and not name.startswith('__MACOSX/')
+    ]
+
+
+def zip_member_file(f, member=0):
+    """A file in the zip archive f, decompressed as a ``StreamFile``.
+
+    Each is read independently of any others open in the same archive.
+
+    :param member: (optional) str, the file's name, or int, its index in
+        ``zip_members``.
+
+    """
+    if isinstance(member, (int, long)):
+        member = zip_members(f)[member]
+    zip_file = zipfile.ZipFile(FileView(f))
+    return StreamFile(lambda: zip_file.open(member))
@@ -0,0 +1,88 @@
+"""
+:copyright: (c) 2014 Building Energy Inc
+:license: see LICENSE for more details.
+
+
+Tells file formats apart by their leading bytes.
+
+Formats are tested for in the order they're registered, with the first
+match winning, so no reader has to be tried on a file just to find out it
+can't read it. Anything unrecognised is taken to be delimited text.
+
+"""
+from mcm import xlsx
+
+# How many leading bytes of a file signatures are tested against.
+HEAD_SIZE = 8
+
+# OLE2 compound documents, as .xls workbooks are.
+OLE2_SIGNATURE = '\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+# BOF records starting bare BIFF2-BIFF8 streams, which xlrd also reads.
+BIFF_BOFS = ('\x09\x00', '\x09\x02', '\x09\x04', '\x09\x08')
+ZIP_SIGNATURE = 'PK\x03\x04'
+GZIP_SIGNATURE = '\x1f\x8b'
+BZ2_SIGNATURE = 'BZh'
+# bz2's block size, in 100k units, follows its signature.
+BZ2_BLOCK_SIZES = '123456789'
+UTF16_BOMS = ('\xff\xfe', '\xfe\xff')
+UTF8_BOM = '\xef\xbb\xbf'
+
+# The name of whatever doesn't match any other format.
+DEFAULT_FORMAT = 'csv'
+
+_signatures = []
+
+
+def register_format(name, test, first=False):
+    """Recognise files as format name when ``test(head, f)`` is true.
+
+    usage:
+            register_format('dbf', lambda head, f: head[:1] == '\\x03')
+
+    :param name: str, the format's name, as returned by ``detect_format``.
+    :param test: callable, given the file's first ``HEAD_SIZE`` bytes and
+        the file itself, at its start; it must leave the file there.
+    :param first: (optional) bool, test for this format before all others,
+        rather than after them.
+
+    """
+    if first:
+        _signatures.insert(0, (name, test))
+    else:
+        _signatures.append((name, test))
+
+
+def detect_format(f):
+    """Name of the format of the open file f. Leaves f at its start.
+
+    :rtype: str, one of the registered formats, or ``DEFAULT_FORMAT``.
+
+    """
+    f.seek(0)
+    head = f.read(HEAD_SIZE)
+    f.seek(0)
+    for name, test in _signatures:
+        if test(head, f):
+            return name
+
+    return DEFAULT_FORMAT
+
+
+register_format(
+    'xls',
+    lambda head, f: head == OLE2_SIGNATURE or head[:2] in BIFF_BOFS
+)
+register_format(
+    'xlsx', lambda head, f: head[:4] == ZIP_SIGNATURE and xlsx.is_xlsx(f)
+)
+register_format('zip', lambda head, f: head[:4] == ZIP_SIGNATURE)
+register_format('gzip', lambda head, f: head[:2] == GZIP_SIGNATURE)
+register_format(
+    'bz2',
+    lambda head, f: (
+        len(head) > 3 and head[:3] == BZ2_SIGNATURE and
+        head[3] in BZ2_BLOCK_SIZES
+    )
+)
+register_format('utf-16', lambda head, f: head[:2] in UTF16_BOMS)
+register_format('utf-8-sig', lambda head, f: head[:3] == UTF8_BOM)
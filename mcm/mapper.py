@@ -4,21 +4,188 @@
 """
 import json
 
+from concurrent.futures import ProcessPoolExecutor
+
 from mcm import matchers
+from mcm import cleaners
+from mcm import utils
 from mcm.cleaners import default_cleaner
 
+# How many templates' matches a MappingStore keeps in memory by default.
+MAX_CACHED_TEMPLATES = 256
+
+# Executor ``build_column_mapping`` spreads fuzzy matching across; see
+# ``set_mapping_executor``.
+_mapping_executor = None
+# Store ``build_column_mapping`` keeps its matches in; see
+# ``set_mapping_store``.
+_mapping_store = None
+
+
+def set_mapping_executor(executor):
+    """Use executor for matching columns in all ``build_column_mapping`` calls.
+
+    Handy for keeping one process pool alive for the life of a server, rather
+    than starting one per request with ``workers``. Calls still pass
+    ``workers``, to split their columns into that many pieces for it.
+
+    :param executor: ``concurrent.futures`` style executor, or None.
+    :returns: the previously set executor.
+
+    """
+    global _mapping_executor
+    previous, _mapping_executor = _mapping_executor, executor
+    return previous
+
+
+class MappingStore(utils.SQLiteCache):
+    """Fuzzy matches of whole sets of raw columns, optionally backed by
+    sqlite.
+
+    Files made from the same template have the same columns, so matching
+    them all again on every upload gives the same answer. Matches are kept
+    per template, keyed by the ordered raw columns and the fingerprint of
+    the destination columns, so changing those never gives stale matches.
+    With a ``path`` they're also written to a sqlite file and survive
+    restarts.
+    Usage:
+            >>> store = MappingStore(path='/tmp/mappings.db')
+            >>> set_mapping_store(store)
+            >>> build_column_mapping(parser.headers(), ontology)  # miss
+            >>> build_column_mapping(parser.headers(), ontology)  # hit
+            >>> store.invalidate(dest_columns=ontology)  # e.g. on upgrade
+
+    """
+    table = 'templates'
+    columns = ('dest', 'matches')
+
+    def __init__(self, max_size=MAX_CACHED_TEMPLATES, path=None):
+        super(MappingStore, self).__init__(max_size, path=path)
+
+    def _dest_fingerprint(self, dest_columns):
+        fingerprint = getattr(dest_columns, 'fingerprint', None)
+        if fingerprint is None:
+            fingerprint = matchers._fingerprint(dest_columns)
+        return fingerprint
+
+    def key(self, raw_columns, dest_columns):
+        """Hash identifying the template raw_columns come from, as mapped
+        to dest_columns."""
+        # Header cells of spreadsheets may be numbers, say.
+        return matchers._fingerprint([
+            matchers._fingerprint([unicode(raw) for raw in raw_columns]),
+            self._dest_fingerprint(dest_columns),
+        ])
+
+    def _dump(self, value):
+        dest, matches = value
+        return dest, json.dumps(matches)
+
+    def _load(self, row):
+        return row[0], json.loads(row[1])
+
+    def get(self, raw_columns, dest_columns):
+        """Return the stored matches for a template, or None.
+
+        :returns: dict, raw column -> [dest column, score], as the best
+            match for it, whatever its score.
+
+        """
+        entry = super(MappingStore, self).get(
+            self.key(raw_columns, dest_columns)
+        )
+        if entry is None:
+            return None
+
+        return dict(entry[1])
+
+    def set(self, raw_columns, dest_columns, matches):
+        """Store a template's matches, as ``get`` returns them."""
+        matches = dict(
+            (raw, list(match)) for raw, match in matches.items()
+        )
+        super(MappingStore, self).set(
+            self.key(raw_columns, dest_columns),
+            (self._dest_fingerprint(dest_columns), matches)
+        )
+
+    def invalidate(self, raw_columns=None, dest_columns=None):
+        """Forget stored matches, on disk too.
+
+        :param raw_columns: (optional) list of str, forget only the
+            template with these columns.
+        :param dest_columns: (optional) list of str, or a
+            ``matchers.ColumnMatcher``, forget only matches to these.
+        :returns: int, how many templates were forgotten.
+
+        """
+        if raw_columns is not None:
+            if dest_columns is None:
+                raise ValueError(
+                    'raw_columns needs dest_columns to invalidate.'
+                )
+            key = self.key(raw_columns, dest_columns)
+            return self._forget(
+                lambda k, entry: k == key, 'key = ?', (key,)
+            )
+        if dest_columns is not None:
+            dest = self._dest_fingerprint(dest_columns)
+            return self._forget(
+                lambda k, entry: entry[0] == dest, 'dest = ?', (dest,)
+            )
+
+        return self._forget(lambda k, entry: True, '1')
+
+
+def set_mapping_store(store):
+    """Keep matches for all ``build_column_mapping`` calls in store.
+
+    :param store: ``MappingStore`` instance, or None to stop storing.
+    :returns: the previously set store.
+
+    """
+    global _mapping_store
+    previous, _mapping_store = _mapping_store, store
+    return previous
+
+
+def _match_columns(unmatched, dest_columns, workers):
+    """Best match for each of unmatched, as ``[dest column, score]``."""
+    executor = _mapping_executor
+    pool = None
+    if executor is None and workers and workers > 1 and len(unmatched) > 1:
+        executor = pool = ProcessPoolExecutor(max_workers=workers)
+    try:
+        matches = matchers.best_matches(
+            [unicode(raw) for raw in unmatched],
+            dest_columns,
+            top_n=1,
+            executor=executor,
+            shards=workers,
+        )
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    return dict(
+        (raw, list(match[0])) for raw, match in zip(unmatched, matches)
+    )
+
 
 def build_column_mapping(
     raw_columns,
     dest_columns,
     previous_mapping=None,
     map_args=None,
-    thresh=None
+    thresh=None,
+    workers=None,
+    store=None
 ):
     """Build a probabalistic mapping structure for mapping raw to dest.
 
     :param raw_columns: list of str. The column names we're trying to map.
-    :param dest_columns: list of str. The columns we're mapping to.
+    :param dest_columns: list of str, or a ``matchers.ColumnMatcher``.
+        The columns we're mapping to.
     :param previous_mapping: callable. Used to return the previous mapping
         for a given field.
 
@@ -29,12 +196,26 @@ def build_column_mapping(
         previous_mapping('example field', *map_args) ->
             ('field_1', 0.93)
         ``
+    :param workers: (optional) int. Match columns across this many worker
+        processes. Uses the executor from ``set_mapping_executor`` if there
+        is one, otherwise starts a pool just for this call. The columns are
+        split into this many pieces, so pass it with a module executor too,
+        e.g. its number of workers; without it they're matched as one.
+        ``previous_mapping`` is always called in this process.
+    :param store: (optional) ``MappingStore``, to reuse the matches of
+        earlier calls with the same raw and dest columns from. Defaults to
+        the store from ``set_mapping_store``, if there is one.
+        ``previous_mapping`` is still called for every column.
 
     :returns dict: {'raw_column': [('dest_column', score)...],...}
 
     """
+    raw_columns = list(raw_columns)
+    if store is None:
+        store = _mapping_store
     probable_mapping = {}
     thresh = thresh or 0
+    unmatched = []
     for raw in raw_columns:
         result = []
         conf = 0
@@ -49,17 +230,28 @@ def build_column_mapping(
         # blank columns with conf of 100 since a conf of 100 signifies the user
         # has saved that mapping.
         if not result and result is not None and conf != 100:
-            best_match, conf = matchers.best_match(
-                raw, dest_columns, top_n=1
-            )[0]
-            if conf > thresh:
-                result = best_match
-            else:
-                result = None
-                conf = 0
+            unmatched.append(raw)
 
         probable_mapping[raw] = [result, conf]
 
+    matches = {}
+    if store is not None and unmatched:
+        matches = store.get(raw_columns, dest_columns) or {}
+    missing = [raw for raw in unmatched if raw not in matches]
+    if missing:
+        # Score everything left in one batch so the work is shared across
+        # columns.
+        matches.update(_match_columns(missing, dest_columns, workers))
+        if store is not None:
+            store.set(raw_columns, dest_columns, matches)
+
+    for raw in unmatched:
+        best_match, conf = matches[raw]
+        if conf > thresh:
+            probable_mapping[raw] = [best_match, conf]
+        else:
+            probable_mapping[raw] = [None, 0]
+
     return probable_mapping
 
 
@@ -92,47 +284,74 @@ def _concat_values(concat_columns, column_values, delimiter):
     return delimiter.join(values) or None
 
 
-def apply_column_value(item, value, model, mapping, cleaner, apply_func=None):
-    """Set the column value as the target attr on our model.
+def _cleaning_name(item, mapping, cleaner):
+    """The column name cleaner knows values of column ``item`` by."""
+    # Cleaners other than ``cleaners.Cleaner`` may only have the lists.
+    float_columns = getattr(cleaner, 'float_column_set', None)
+    if float_columns is None:
+        float_columns = getattr(cleaner, 'float_columns', ())
+    date_columns = getattr(cleaner, 'date_column_set', None)
+    if date_columns is None:
+        date_columns = getattr(cleaner, 'date_columns', ())
+    if item in (float_columns or date_columns):
+        return item
+    # Try using a reverse mapping for dynamic maps;
+    # default to row name if it's not mapped
+    return mapping.get(item, item)
 
-    :param item: str, the column name as the mapping understands it.
-    :param value: dict, the value of that column for a given row.
-    :param model: inst, the object we're mapping data to.
-    :param mapping: dict, the mapping of row data to attribute data.
-    :param cleaner: runnable, something to clean data values.
-    :param apply: (optional), function to apply value to our model.
-    :rtype: model inst
 
-    """
-    column_name = item
-    if cleaner:
-        if item not in (cleaner.float_columns or cleaner.date_columns):
-            # Try using a reverse mapping for dynamic maps;
-            # default to row name if it's not mapped
-            column_name = mapping.get(item, column_name)
-
-        cleaned_value = cleaner.clean_value(value, column_name)
-    else:
-        cleaned_value = default_cleaner(value)
+def _column_cleaner(item, mapping, cleaner):
+    """Return the function which cleans values of column ``item``."""
+    if not cleaner:
+        return default_cleaner
+
+    column_name = _cleaning_name(item, mapping, cleaner)
+
+    def clean(value):
+        return cleaner.clean_value(value, column_name)
+
+    return clean
+
+
+def _set_column_value(item, value, model, mapping, apply_func=None):
+    """Set an already cleaned value as the target attr on our model."""
     if item in mapping:
         if apply_func and callable(apply_func):
             # If we need to call a function to apply our value, do so.
             # We use the 'mapped' name of the column, and the cleaned value.
-            apply_func(model, mapping.get(item), cleaned_value)
+            apply_func(model, mapping.get(item), value)
         else:
-            setattr(model, mapping.get(item), cleaned_value)
+            setattr(model, mapping.get(item), value)
     elif hasattr(model, 'extra_data'):
         if not isinstance(model.extra_data, dict):
             # sometimes our dict is returned as JSON string.
             # TODO: Need to resolve this upstream with djorm-ext-jsonfield.
             model.extra_data = json.loads(model.extra_data)
-        model.extra_data[item] = cleaned_value
+        model.extra_data[item] = value
     else:
-        model.extra_data = {item: cleaned_value}
+        model.extra_data = {item: value}
 
     return model
 
 
+def apply_column_value(item, value, model, mapping, cleaner, apply_func=None):
+    """Set the column value as the target attr on our model.
+
+    :param item: str, the column name as the mapping understands it.
+    :param value: dict, the value of that column for a given row.
+    :param model: inst, the object we're mapping data to.
+    :param mapping: dict, the mapping of row data to attribute data.
+    :param cleaner: runnable, something to clean data values.
+    :param apply: (optional), function to apply value to our model.
+    :rtype: model inst
+
+    """
+    cleaned_value = _column_cleaner(item, mapping, cleaner)(value)
+    return _set_column_value(
+        item, cleaned_value, model, mapping, apply_func=apply_func
+    )
+
+
 def _set_default_concat_config(concat):
     """Go through the list of dictionaries and setup their keys."""
     concat = concat or []
@@ -147,9 +366,311 @@ def _set_default_concat_config(concat):
     return concat
 
 
+class MappingPlan(object):
+    """Everything ``map_row`` needs to know about each column, worked out
+    once per file rather than once per cell.
+
+    Built by ``compile_mapping``; columns are planned the first time they're
+    seen, so rows needn't all share the same keys.
+
+    usage:
+            plan = compile_mapping(mapping, model_class, cleaner=cleaner)
+            for row in rows:
+                model = plan.map(row)
+
+    """
+    def __init__(
+        self,
+        mapping,
+        model_class,
+        cleaner=None,
+        concat=None,
+        apply_columns=None,
+        apply_func=None,
+        initial_data=None,
+    ):
+        self.mapping = dict(mapping)
+        self.model_class = model_class
+        self.cleaner = cleaner
+        self.concat = _set_default_concat_config(concat)
+        self.apply_columns = frozenset(apply_columns or [])
+        self.apply_func = apply_func if callable(apply_func) else None
+        self.initial_data = initial_data
+        self._columns = {}
+        self._key_columns_by_key = {}
+        self._targets = []
+        self._target_mapping = self.mapping
+        if self.concat:
+            # Concatenated values are set on their target like a mapped
+            # column of the same name.
+            target_mapping = dict(self.mapping)
+            for c in self.concat:
+                target_mapping[c['target']] = c['target']
+            for c in self.concat:
+                self._targets.append((
+                    c['target'],
+                    c['concat_columns'],
+                    c['delimiter'],
+                    _column_cleaner(c['target'], target_mapping, cleaner),
+                ))
+            self._target_mapping = target_mapping
+
+    def _plan_column(self, item):
+        """Work out, and remember, how to handle values of column item.
+
+        :returns: tuple, (concat slots, cleaning function, apply function)
+
+        """
+        slots = tuple(
+            i for i, c in enumerate(self.concat)
+            if item in c['concat_columns']
+        )
+        apply_func = self.apply_func if item in self.apply_columns else None
+        plan = self._columns[item] = (
+            slots,
+            _column_cleaner(item, self.mapping, self.cleaner),
+            apply_func,
+        )
+
+        return plan
+
+    def _new_model(self):
+        model = self.model_class()
+        # If there are any initial states we need to set prior to mapping.
+        if self.initial_data:
+            model = apply_initial_data(model, self.initial_data)
+
+        return model
+
+    def _set_concat_values(self, model, concat_values):
+        """Concatenate each concat config's values, and set its target."""
+        for values, (target, concat_columns, delimiter, clean) in zip(
+            concat_values, self._targets
+        ):
+            concated_vals = _concat_values(concat_columns, values, delimiter)
+            model = _set_column_value(
+                target,
+                clean(concated_vals),
+                model,
+                self._target_mapping,
+                apply_func=self.apply_func,
+            )
+
+        return model
+
+    def _key_columns(self, key):
+        """Columns mapped to the model attribute key."""
+        if key not in self._key_columns_by_key:
+            self._key_columns_by_key[key] = [
+                item for item, target in self.mapping.items() if target == key
+            ]
+
+        return self._key_columns_by_key[key]
+
+    def row_key(self, row, key):
+        """The cleaned value row has for the model attribute key, or None.
+
+        :param key: str, model attribute, e.g. ``pm_property_id``.
+
+        """
+        for item in self._key_columns(key):
+            value = row.get(item)
+            if value:
+                slots, clean, apply_func = (
+                    self._columns.get(item) or self._plan_column(item)
+                )
+                return clean(value)
+
+        return None
+
+    def resolve(self, keys, key, lookup):
+        """Models to map rows with keys onto, looking them all up at once.
+
+        Rows without a key get new models, as do those whose key isn't
+        found; rows with the same key share a model.
+
+        :param keys: list, each row's key, e.g. from ``row_key``.
+        :param key: str, model attribute the keys are values of.
+        :param lookup: callable, given a list of distinct keys, returns the
+            existing models for those it finds: a dict of key -> model, or
+            an iterable of models, whose key attributes equal their keys.
+        :rtype: list of model_inst, one per key.
+
+        """
+        wanted = list(set(k for k in keys if k is not None))
+        found = lookup(wanted) if wanted else {}
+        if isinstance(found, dict):
+            found = dict(found)
+        else:
+            found = dict((getattr(model, key), model) for model in found)
+
+        models = []
+        for k in keys:
+            model = found.get(k) if k is not None else None
+            if model is None:
+                model = self._new_model()
+                if k is not None:
+                    found[k] = model
+            models.append(model)
+
+        return models
+
+    def map_batch(self, rows, key, lookup):
+        """Map rows onto their existing models, or new ones.
+
+        Existing models are found by their key, with one ``lookup`` call
+        for all the rows; see ``resolve``. Initial data is only set on new
+        models.
+
+        :param rows: list of dict, parsed row data from csv.
+        :rtype: list of model_inst, one per row.
+
+        """
+        models = self.resolve(
+            [self.row_key(row, key) for row in rows], key, lookup
+        )
+        return [self.map(row, model) for row, model in zip(rows, models)]
+
+    def map(self, row, model=None):
+        """Apply the mapping of row data to a model.
+
+        :param row: dict, parsed row data from csv.
+        :param model: (optional) model_inst to update; by default, a new one.
+        :rtype: model_inst, with mapped data attributes; ready to save.
+
+        """
+        if model is None:
+            model = self._new_model()
+        concat_values = [{} for c in self.concat]
+        columns = self._columns
+        mapping = self.mapping
+        for item, value in row.items():
+            slots, clean, apply_func = (
+                columns.get(item) or self._plan_column(item)
+            )
+            # Columns we're concatenating are set aside for merging with
+            # others at the end of the map, as well as being mapped.
+            for slot in slots:
+                concat_values[slot][item] = value
+
+            if value:
+                model = _set_column_value(
+                    item, clean(value), model, mapping, apply_func=apply_func
+                )
+
+        # Now we concatenate them all and save to their designated target.
+        return self._set_concat_values(model, concat_values)
+
+    def clean_column(self, item, values):
+        """Clean every value of column item at once, as ``map`` would."""
+        if not self.cleaner:
+            return cleaners.clean_column(values, default_cleaner)
+
+        if not hasattr(self.cleaner, 'clean_column'):
+            return cleaners.clean_column(
+                values, _column_cleaner(item, self.mapping, self.cleaner)
+            )
+
+        return self.cleaner.clean_column(
+            values, _cleaning_name(item, self.mapping, self.cleaner)
+        )
+
+    def map_columns(self, columns, key=None, lookup=None):
+        """Map a batch of rows held as columns to models.
+
+        Gives the same models as calling ``map`` on each row, but cleans a
+        column at a time, so each distinct value is only cleaned once.
+
+        :param columns: dict, column name -> list of values, one per row;
+            e.g. from ``MCMParser.column_batches``.
+        :param key: (optional) str, model attribute to find existing models
+            by with lookup, as for ``map_batch``; by default, all models
+            are new.
+        :param lookup: (optional) callable, see ``resolve``.
+        :rtype: list of model_inst, one per row.
+
+        """
+        planned = []
+        cleaned_columns = {}
+        for item, values in columns.items():
+            slots, clean, apply_func = (
+                self._columns.get(item) or self._plan_column(item)
+            )
+            cleaned = cleaned_columns[item] = self.clean_column(item, values)
+            planned.append((item, values, cleaned, slots, apply_func))
+
+        num_rows = max([len(values) for values in columns.values()] or [0])
+        if lookup is not None:
+            keys = [None] * num_rows
+            for item in reversed(self._key_columns(key)):
+                if item not in columns:
+                    continue
+                # The first of the key's columns with a value wins.
+                for i, value in enumerate(columns[item]):
+                    if value:
+                        keys[i] = cleaned_columns[item][i]
+            models = self.resolve(keys, key, lookup)
+        else:
+            models = [None] * num_rows
+
+        mapping = self.mapping
+        for i in range(num_rows):
+            model = models[i]
+            if model is None:
+                model = self._new_model()
+            concat_values = [{} for c in self.concat]
+            for item, values, cleaned, slots, apply_func in planned:
+                value = values[i]
+                # None stands in for columns missing from a row, which
+                # ``map`` would have nothing to concatenate for.
+                if value is not None:
+                    for slot in slots:
+                        concat_values[slot][item] = value
+
+                if value:
+                    model = _set_column_value(
+                        item, cleaned[i], model, mapping,
+                        apply_func=apply_func
+                    )
+
+            models[i] = self._set_concat_values(model, concat_values)
+
+        return models
+
+
+def compile_mapping(
+    mapping,
+    model_class,
+    cleaner=None,
+    concat=None,
+    apply_columns=None,
+    apply_func=None,
+    initial_data=None,
+):
+    """Precompute how each column gets mapped, for mapping many rows.
+
+    Takes the same arguments as ``map_row``, less the row.
+
+    :rtype: MappingPlan, call ``plan.map(row)`` for each row.
+
+    """
+    return MappingPlan(
+        mapping,
+        model_class,
+        cleaner=cleaner,
+        concat=concat,
+        apply_columns=apply_columns,
+        apply_func=apply_func,
+        initial_data=initial_data,
+    )
+
+
 def map_row(row, mapping, model_class, cleaner=None, concat=None, **kwargs):
     """Apply mapping of row data to model.
 
+    When mapping many rows with the same arguments, ``compile_mapping`` once
+    and use its ``map`` instead.
+
     :param row: dict, parsed row data from csv.
     :param mapping: dict, keys map row columns to model_class attrs.
     :param model_class: class, reference to model class we map against.
@@ -159,52 +680,12 @@ def map_row(row, mapping, model_class, cleaner=None, concat=None, **kwargs):
     :rtype: model_inst, with mapped data attributes; ready to save.
 
     """
-    initial_data = kwargs.get('initial_data', None)
-    apply_columns = kwargs.get('apply_columns', [])
-    apply_func = kwargs.get('apply_func', None)
-    model = model_class()
-    # If there are any initial states we need to set prior to mapping.
-    if initial_data:
-        model = apply_initial_data(model, initial_data)
-
-    concat = _set_default_concat_config(concat)
-
-    # In case we need to look up cleaner by dynamic field mapping.
-    for item, value in row.items():
-        # Look through any of our concatenation configs to see if this row
-        # needs to be set aside for mergning with others at the end of the map.
-        for concat_column in concat:
-            if item in concat_column['concat_columns']:
-                concat_column['concat_values'][item] = value
-                continue
-
-        # If our item is a column which requires that we apply the function
-        # then, send_apply_func will reference this function and be sent
-        # to the ``apply_column_value`` function.
-        send_apply_func = apply_func if item in apply_columns else None
-        if value and value != '':
-            model = apply_column_value(
-                item, value, model, mapping, cleaner,
-                apply_func=send_apply_func
-            )
-
-    if concat and [c['concat_values'] for c in concat]:
-        # We've skipped mapping any columns which we're going to concat.
-        # Now we concatenate them all and save to their designated target.
-        for c in concat:
-            mapping[c['target']] = c['target']
-            concated_vals = _concat_values(
-                c['concat_columns'],
-                c['concat_values'],
-                c['delimiter']
-            )
-            model = apply_column_value(
-                c['target'],
-                concated_vals,
-                model,
-                mapping,
-                cleaner,
-                apply_func=apply_func,
-            )
-
-    return model
+    return compile_mapping(
+        mapping,
+        model_class,
+        cleaner=cleaner,
+        concat=concat,
+        apply_columns=kwargs.get('apply_columns', []),
+        apply_func=kwargs.get('apply_func', None),
+        initial_data=kwargs.get('initial_data', None),
+    ).map(row)
@@ -2,8 +2,651 @@
 :copyright: (c) 2014 Building Energy Inc
 :license: see LICENSE for more details.
 """
+from collections import defaultdict
+import hashlib
+import heapq
+import json
+
 import jellyfish
 
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+from mcm import utils
+
+# Jaro-Winkler's boost per shared leading character (up to four of them).
+WINKLER_WEIGHT = 0.1
+# Slack for float rounding when comparing bounds against real scores.
+EPSILON = 1e-9
+# How many distinct category sets we keep indexes around for.
+MAX_CACHED_MATCHERS = 32
+# Candidates a lookup always bound-checks before judging if it's worth it.
+PROBE_SIZE = 64
+# Raw columns scored together per block of the batched bound matrix.
+BATCH_BLOCK_SIZE = 16
+
+# How many best_match results a MatchCache keeps in memory by default.
+MATCH_CACHE_SIZE = 4096
+# How many answers a SynonymSet remembers before starting over.
+SYNONYM_MEMO_SIZE = 10000
+
+_matchers = {}
+_match_cache = None
+
+
+def _normalize(s):
+    """Put a string into the form our scorer compares."""
+    return s.encode('ascii', 'replace').upper()
+
+
+def _fingerprint(categories):
+    """Hash identifying an ordered set of categories."""
+    digest = hashlib.sha1()
+    for cat in categories:
+        if isinstance(cat, unicode):
+            cat = cat.encode('utf-8')
+        digest.update(cat)
+        digest.update('\x00')
+
+    return digest.hexdigest()
+
+
+def _upper_bound(common, len_a, len_b, prefix=4):
+    """Best possible Jaro-Winkler score given ``common`` matchable characters
+    and a ``prefix`` long shared start.
+
+    Jaro-Winkler can never match more characters than the strings share, and
+    transpositions only ever lower the score, so this is a safe ceiling.
+
+    """
+    if not common:
+        return 0.0
+    common = float(common)
+    bound = (common / len_a + common / len_b + 1.0) / 3
+    if len_a > 3 and len_b > 3:
+        bound += min(prefix, 4) * WINKLER_WEIGHT * (1.0 - bound)
+
+    return bound
+
+
+def _min_common(threshold, len_a, len_b):
+    """Fewest common characters that could still reach ``threshold``.
+
+    :returns: list indexed by shared prefix length (0-4), or None if there's
+        nothing to prune against.
+
+    """
+    if threshold <= 0:
+        return None
+
+    needed = []
+    for prefix in range(5):
+        boost = 0.0
+        if len_a > 3 and len_b > 3:
+            boost = prefix * WINKLER_WEIGHT
+        # Invert ``_upper_bound`` for the Jaro part, then the common count.
+        jaro = (threshold - EPSILON - boost) / (1.0 - boost)
+        needed.append(
+            (jaro * 3 - 1.0) / (1.0 / len_a + 1.0 / len_b) - EPSILON
+        )
+
+    return needed
+
+
+def _length_window(length, floor, prefix):
+    """Range of string lengths which could score ``floor`` or better against
+    a string of ``length``, sharing ``prefix`` leading characters.
+
+    :returns: tuple (shortest, longest), longest is None if unbounded; or
+        None if no length could.
+
+    """
+    def reaches(other):
+        bound = _upper_bound(min(length, other), length, other, prefix)
+        return bound + EPSILON >= floor
+
+    shortest = None
+    for other in range(1, length + 1):
+        if reaches(other):
+            shortest = other
+            break
+    if shortest is None:
+        return None
+
+    # As the other string grows its score tends to (1 + 0 + 1) / 3, plus any
+    # Winkler boost; if that's good enough there's no upper limit.
+    limit = 2 / 3.0
+    if length > 3:
+        limit += min(prefix, 4) * WINKLER_WEIGHT * (1.0 - limit)
+    if limit + EPSILON >= floor:
+        return shortest, None
+
+    longest = length
+    while reaches(longest + 1):
+        longest += 1
+
+    return shortest, longest
+
+
+def _charset(s):
+    """Return the distinct characters of ``s`` as a deletable str."""
+    return ''.join(set(s))
+
+
+def _code_point_counts(s):
+    """Occurrences of each ASCII code point in a normalized string."""
+    counts = [0] * 128
+    for ch in s:
+        counts[ord(ch)] += 1
+
+    return counts
+
+
+def _code_point_prefix(s, fill=-1):
+    """The first four code points of s, padded out with ``fill``."""
+    return [ord(ch) for ch in s[:4]] + [fill] * (4 - len(s[:4]))
+
+
+def _prefix_len(a, b):
+    """Length of the shared start of a and b, up to Winkler's four chars."""
+    i = 0
+    limit = min(len(a), len(b), 4)
+    while i < limit and a[i] == b[i]:
+        i += 1
+
+    return i
+
+
+class ColumnMatcher(object):
+    """Index of categories for repeated fuzzy lookups against them.
+
+    Categories are normalized once and bucketed by length, so each lookup
+    only scores the candidates whose Jaro-Winkler upper bound can still beat
+    the current top N.
+    Usage:
+            >>> matcher = ColumnMatcher(['Michigan', 'Ohio', 'Illinois'])
+            >>> matcher.best_match('ilinois', 2)
+            [('Illinois', 96), ('Michigan', 22)]
+
+    """
+    def __init__(self, categories, cache=None):
+        self.categories = list(categories)
+        # A MatchCache, None for the one from ``set_match_cache``, or False
+        # never to cache.
+        self.cache = cache
+        self.fingerprint = _fingerprint(self.categories)
+        self._exact = defaultdict(list)
+        self._buckets = defaultdict(list)
+        for index, cat in enumerate(self.categories):
+            normalized = _normalize(cat)
+            self._exact[normalized].append(index)
+            self._buckets[len(normalized)].append(
+                (index, normalized, _charset(normalized))
+            )
+        self._normalized = None
+        if numpy is not None:
+            self._build_arrays()
+
+    def _build_arrays(self):
+        """Pre-encode categories as code-point arrays for batch scoring."""
+        self._normalized = [_normalize(cat) for cat in self.categories]
+        self._lengths = numpy.array(
+            [len(cat) for cat in self._normalized], dtype=numpy.float64
+        )
+        self._counts = numpy.array(
+            [_code_point_counts(cat) for cat in self._normalized],
+            dtype=numpy.int32,
+        ).reshape(len(self._normalized), 128)
+        # Only characters some category uses can ever be matched.
+        self._alphabet = numpy.flatnonzero(self._counts.sum(axis=0))
+        self._counts = self._counts[:, self._alphabet]
+        self._prefixes = numpy.array(
+            [_code_point_prefix(cat) for cat in self._normalized],
+            dtype=numpy.int16,
+        ).reshape(len(self._normalized), 4)
+
+    def __len__(self):
+        return len(self.categories)
+
+    def _ordered_buckets(self, length):
+        """Return (bound, length, entries) per length bucket, best first."""
+        buckets = [
+            (_upper_bound(min(length, cat_len), length, cat_len),
+             cat_len,
+             entries)
+            for cat_len, entries in self._buckets.items()
+        ]
+        buckets.sort(key=lambda x: x[0], reverse=True)
+
+        return buckets
+
+    def _top_scores(self, s, top_n, floor=0.0, normalized=False):
+        """Return a min-heap of the ``top_n`` best (score, index) pairs.
+
+        Ties go to the category listed last, same as a stable sort would.
+
+        :param floor: float, skip candidates which can't reach this score.
+        :param normalized: bool, s has already been through ``_normalize``.
+
+        """
+        query = s if normalized else _normalize(s)
+        query_len = len(query)
+        query_chars = _charset(query)
+        heap = []
+
+        def push(item):
+            if len(heap) < top_n:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+
+            return heap[0][0] if len(heap) >= top_n else floor
+
+        # Identical strings always score a perfect 1.0, which lets the
+        # bounds below throw out nearly everything else.
+        exact = self._exact.get(query) if query else None
+        threshold = floor
+        # Checking bounds costs a fraction of a score; when they stop pruning
+        # at least a quarter of what they check, skip them until the bar
+        # moves again.
+        checked = pruned = 0
+        for index in exact or []:
+            threshold = push((1.0, index))
+
+        for bucket_bound, cat_len, entries in self._ordered_buckets(
+            query_len
+        ):
+            if bucket_bound + EPSILON < threshold:
+                # Buckets are sorted by bound, nothing left can compete.
+                break
+
+            needed = _min_common(threshold, query_len, cat_len)
+            for index, normalized, chars in entries:
+                if exact and normalized == query:
+                    continue
+
+                if needed and (checked < PROBE_SIZE or pruned * 4 > checked):
+                    checked += 1
+                    # Characters missing from the other string can never
+                    # be matched, whichever side they're on.
+                    common = cat_len - len(
+                        normalized.translate(None, query_chars)
+                    )
+                    if common < needed[-1]:
+                        pruned += 1
+                        continue
+                    common = min(
+                        common, query_len - len(query.translate(None, chars))
+                    )
+                    if common < needed[0] and common < needed[
+                        _prefix_len(query, normalized)
+                    ]:
+                        pruned += 1
+                        continue
+
+                new_threshold = push(
+                    (jellyfish.jaro_winkler(query, normalized), index)
+                )
+                if new_threshold != threshold:
+                    threshold = new_threshold
+                    needed = _min_common(threshold, query_len, cat_len)
+                    # A higher bar prunes more, so give the bounds another go.
+                    checked = pruned = 0
+
+        return heap
+
+    def best_match(self, s, top_n=5):
+        """Return the top N best matches with the best in the 0th position.
+
+        :param s: str value to find best match
+        :param top_n: number of matches to return
+        :returns: list of tuples (guess, percentage)
+
+        """
+        cache = self._get_cache()
+        if cache is None:
+            return self._results(self._top_scores(s, top_n))
+
+        key = (_normalize(s), self.fingerprint, top_n)
+        result = cache.get(key)
+        if result is None:
+            result = self._results(self._top_scores(s, top_n))
+            cache.set(key, result)
+
+        return list(result)
+
+    def _get_cache(self):
+        """Our own MatchCache, or the module wide one if we weren't given
+        one."""
+        if self.cache is False:
+            return None
+        return self.cache if self.cache is not None else _match_cache
+
+    def _results(self, heap):
+        """Turn a heap of (score, index) into best_match's return value."""
+        return [
+            (self.categories[index], int(score * 100))
+            for score, index in sorted(heap, reverse=True)
+        ]
+
+    def _bound_matrix(self, queries):
+        """Upper bound score of every query against every category.
+
+        :param queries: list of normalized str.
+        :returns: numpy array, one row per query, one column per category.
+
+        """
+        query_counts = numpy.array(
+            [_code_point_counts(q) for q in queries], dtype=numpy.int32
+        ).reshape(len(queries), 128)[:, self._alphabet]
+        query_prefixes = numpy.array(
+            [_code_point_prefix(q, fill=-2) for q in queries],
+            dtype=numpy.int16,
+        ).reshape(len(queries), 4)
+        query_lengths = numpy.array(
+            [len(q) for q in queries], dtype=numpy.float64
+        )[:, None]
+
+        # Multiset intersection of characters: nothing else can match.
+        common = numpy.minimum(
+            query_counts[:, None, :], self._counts[None, :, :]
+        ).sum(axis=2).astype(numpy.float64)
+        prefix = numpy.cumprod(
+            query_prefixes[:, None, :] == self._prefixes[None, :, :], axis=2
+        ).sum(axis=2)
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            jaro = (common / query_lengths + common / self._lengths + 1) / 3
+        jaro[common == 0] = 0.0
+        winkler = (query_lengths > 3) & (self._lengths > 3)[None, :]
+
+        return jaro + winkler * prefix * WINKLER_WEIGHT * (1.0 - jaro)
+
+    def _ranked_top_scores(self, query, top_n, bounds):
+        """``_top_scores`` for a query whose bounds are already known.
+
+        Candidates are scored best bound first, so we can stop at the first
+        one that can't beat the current top N.
+
+        """
+        heap = []
+        exact = self._exact.get(query) if query else None
+        for index in exact or []:
+            if len(heap) < top_n:
+                heapq.heappush(heap, (1.0, index))
+            elif (1.0, index) > heap[0]:
+                heapq.heapreplace(heap, (1.0, index))
+
+        # Stable sort keeps later categories after earlier ones on a tie;
+        # walking it backwards means ties come in the order they win in.
+        order = numpy.argsort(bounds, kind='mergesort')[::-1].tolist()
+        bounds = bounds.tolist()
+        for index in order:
+            if len(heap) >= top_n and bounds[index] + EPSILON < heap[0][0]:
+                break
+            normalized = self._normalized[index]
+            if exact and normalized == query:
+                continue
+
+            item = (jellyfish.jaro_winkler(query, normalized), index)
+            if len(heap) < top_n:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+
+        return heap
+
+    def best_matches(self, strings, top_n=1, executor=None, shards=None):
+        """Batched ``best_match``, for many strings against our categories.
+
+        When numpy is available the upper bounds for a block of strings
+        against every category are computed as one matrix, and each string
+        only scores candidates in bound order until none can compete.
+
+        :param strings: list of str values to find best matches for
+        :param top_n: number of matches to return per string
+        :param executor: (optional) ``concurrent.futures`` style executor to
+            spread the scoring across; the cache is still only used here.
+        :param shards: (optional) int, how many pieces to split the work into
+            for the executor; one per worker is best, since each piece ships
+            our categories along with it.
+        :returns: list, the ``best_match`` result for each string, in order
+
+        """
+        strings = list(strings)
+        results = [None] * len(strings)
+        cache = self._get_cache()
+        keys = [(_normalize(s), self.fingerprint, top_n) for s in strings]
+        if cache is not None:
+            results = [cache.get(key) for key in keys]
+
+        missing = [i for i, result in enumerate(results) if result is None]
+        queries = [keys[i][0] for i in missing]
+        if executor is not None and len(queries) > 1:
+            shards = max(1, min(shards or 1, len(queries)))
+            size = -(-len(queries) // shards)
+            futures = [
+                executor.submit(
+                    _match_shard,
+                    self.categories,
+                    queries[start:start + size],
+                    top_n,
+                )
+                for start in range(0, len(queries), size)
+            ]
+            matches = []
+            for future in futures:
+                matches.extend(future.result())
+        else:
+            matches = self._compute_matches(queries, top_n)
+
+        for i, result in zip(missing, matches):
+            results[i] = result
+            if cache is not None:
+                cache.set(keys[i], result)
+
+        return [list(result) for result in results]
+
+    def _compute_matches(self, queries, top_n):
+        """Score normalized queries, without consulting any cache."""
+        if self._normalized is None or not self.categories:
+            return [
+                self._results(self._top_scores(query, top_n, normalized=True))
+                for query in queries
+            ]
+
+        results = []
+        for start in range(0, len(queries), BATCH_BLOCK_SIZE):
+            block = queries[start:start + BATCH_BLOCK_SIZE]
+            for query, bounds in zip(block, self._bound_matrix(block)):
+                heap = self._ranked_top_scores(query, top_n, bounds)
+                results.append(self._results(heap))
+
+        return results
+
+    def fuzzy_in_set(self, column_name, percent_confidence=95):
+        """Return True if column_name is in our categories."""
+        # ``int(score * 100) > percent_confidence`` needs at least this score.
+        cache = self._get_cache()
+        if cache is not None:
+            # Only full top-1 results are cached; the pruned lookup below
+            # isn't one, so it's never stored.
+            result = cache.peek((_normalize(column_name), self.fingerprint, 1))
+            if result is not None:
+                return bool(result) and result[0][1] > percent_confidence
+
+        floor = (int(percent_confidence) + 1) / 100.0
+        heap = self._top_scores(column_name, 1, floor=floor - EPSILON)
+        if not heap:
+            return False
+
+        return int(heap[0][0] * 100) > percent_confidence
+
+
+class SynonymSet(object):
+    """Fuzzy membership test against a small, fixed set of strings, for
+    checking lots of values quickly.
+
+    Checks go from cheapest to dearest: a memo of earlier answers, an exact
+    match, the lengths and first characters which could possibly score high
+    enough, and only then the fuzzy comparison ``fuzzy_in_set`` would do.
+    Usage:
+            >>> nulls = SynonymSet([u'not available', u'n/a'])
+            >>> u'not availble' in nulls
+            True
+            >>> u'123.4' in nulls
+            False
+
+    """
+    def __init__(
+        self,
+        synonyms,
+        percent_confidence=95,
+        memo_size=SYNONYM_MEMO_SIZE
+    ):
+        # Our memo is cheaper than any MatchCache, which would only slow
+        # down checks of values it has never seen.
+        self.matcher = ColumnMatcher(synonyms, cache=False)
+        self.percent_confidence = percent_confidence
+        self.memo_size = memo_size
+        self._memo = {}
+        # Identical strings score 100, which only fails a 100% confidence.
+        self._exact = frozenset()
+        if percent_confidence < 100:
+            self._exact = frozenset(
+                _normalize(s) for s in self.matcher.categories if s
+            )
+
+        # Length windows for values by their first character. Without a
+        # shared first character there's no Winkler boost to count on.
+        floor = (int(percent_confidence) + 1) / 100.0
+        self._any_start = []
+        by_start = defaultdict(list)
+        for synonym in set(_normalize(s) for s in self.matcher.categories):
+            if not synonym:
+                continue
+            window = _length_window(len(synonym), floor, 0)
+            if window:
+                self._any_start.append(window)
+            window = _length_window(len(synonym), floor, 4)
+            if window:
+                by_start[synonym[0]].append(window)
+        self._by_start = dict(
+            (start, windows + self._any_start)
+            for start, windows in by_start.items()
+        )
+
+    def _could_match(self, normalized):
+        """Whether normalized is a length any synonym could match."""
+        length = len(normalized)
+        windows = self._by_start.get(normalized[:1], self._any_start)
+        for shortest, longest in windows:
+            if shortest <= length and (longest is None or length <= longest):
+                return True
+
+        return False
+
+    def _lookup(self, value):
+        normalized = _normalize(value)
+        if normalized in self._exact:
+            return True
+        if not self._could_match(normalized):
+            return False
+
+        return self.matcher.fuzzy_in_set(value, self.percent_confidence)
+
+    def __contains__(self, value):
+        memo = self._memo
+        found = memo.get(value)
+        if found is None:
+            found = self._lookup(value)
+            if len(memo) >= self.memo_size:
+                memo.clear()
+            memo[value] = found
+
+        return found
+
+
+class MatchCache(utils.SQLiteCache):
+    """LRU cache of ``best_match`` results, optionally backed by sqlite.
+
+    Results are keyed by (normalized string, category fingerprint, top_n), so
+    a changed set of categories never sees stale matches. With a ``path`` the
+    results are also written to a sqlite file and survive restarts.
+    Usage:
+            >>> cache = MatchCache(max_size=1000, path='/tmp/matches.db')
+            >>> set_match_cache(cache)
+            >>> best_match('Site EUI', ontology, top_n=1)  # miss
+            >>> best_match('SITE EUI', ontology, top_n=1)  # hit
+            >>> cache.stats()
+            {'hits': 1, 'misses': 1, 'size': 1, 'hit_rate': 0.5}
+
+    """
+    table = 'matches'
+    columns = ('result',)
+
+    def __init__(self, max_size=MATCH_CACHE_SIZE, path=None):
+        super(MatchCache, self).__init__(max_size, path=path)
+
+    def _db_key(self, key):
+        return json.dumps(key)
+
+    def _dump(self, result):
+        return (json.dumps(result),)
+
+    def _load(self, row):
+        return [tuple(match) for match in json.loads(row[0])]
+
+    def set(self, key, result):
+        """Store a ``best_match`` result for key."""
+        super(MatchCache, self).set(
+            key, [tuple(match) for match in result]
+        )
+
+
+def set_match_cache(cache):
+    """Use cache for all matchers not given a cache of their own.
+
+    :param cache: MatchCache instance, or None to turn caching off.
+    :returns: the previously set cache.
+
+    """
+    global _match_cache
+    previous, _match_cache = _match_cache, cache
+    return previous
+
+
+def _match_shard(categories, queries, top_n):
+    """Score a piece of a ``best_matches`` batch, e.g. in a worker process.
+
+    Workers keep their own index per category set, so a long lived pool
+    only builds it once.
+
+    """
+    return get_matcher(categories)._compute_matches(queries, top_n)
+
+
+def get_matcher(categories):
+    """Return a ``ColumnMatcher`` for categories, reusing one if we can.
+
+    :param categories: iterable of str, or an existing ``ColumnMatcher``.
+    :rtype: ColumnMatcher
+
+    """
+    if isinstance(categories, ColumnMatcher):
+        return categories
+
+    key = tuple(categories)
+    matcher = _matchers.get(key)
+    if matcher is None:
+        if len(_matchers) >= MAX_CACHED_MATCHERS:
+            _matchers.clear()
+        matcher = _matchers[key] = ColumnMatcher(key)
+
+    return matcher
+
 
 def best_match(s, categories, top_n=5):
     """Return the top N best matches from your categories with the best match
@@ -13,29 +656,33 @@ def best_match(s, categories, top_n=5):
             [('Illinois', 96), ('Michigan', 22)]
 
     :param s: str value to find best match
-    :param categories: list values to compare against
+    :param categories: list values to compare against, or a ColumnMatcher
     :param top_n: number of matches to return
     :returns: list of tuples (guess, percentage)
     """
-    scores = []
-    for cat in categories:
-        scores.append((cat, jellyfish.jaro_winkler(
-            s.encode('ascii', 'replace').upper(),
-            cat.encode('ascii', 'replace').upper()
-        )))
+    return get_matcher(categories).best_match(s, top_n=top_n)
 
-    scores = sorted(scores, key=lambda x: x[1])
-    scores = scores[-top_n:]
-    scores = [(score[0], int(score[1] * 100)) for score in scores]
-    scores.reverse()
 
-    return scores
+def best_matches(strings, categories, top_n=1, executor=None, shards=None):
+    """Return ``best_match`` results for each of strings, in order.
+
+    Scores the whole batch in one pass, sharing normalization and candidate
+    pruning across strings; see ``ColumnMatcher.best_matches``.
+
+    :param strings: list of str values to find best matches for
+    :param categories: list values to compare against, or a ColumnMatcher
+    :param top_n: number of matches to return per string
+    :param executor: (optional) executor to spread the scoring across
+    :param shards: (optional) int, pieces to split the work into
+    :returns: list of lists of tuples (guess, percentage)
+    """
+    return get_matcher(categories).best_matches(
+        strings, top_n=top_n, executor=executor, shards=shards
+    )
 
 
 def fuzzy_in_set(column_name, ontology, percent_confidence=95):
     """Return True if column_name is in the ontology."""
-    match, percent = best_match(
-        column_name, ontology, top_n=1
-    )[0]
-
-    return percent > percent_confidence
+    return get_matcher(ontology).fuzzy_in_set(
+        column_name, percent_confidence=percent_confidence
+    )
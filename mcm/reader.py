@@ -8,16 +8,23 @@ out of CSV files. Fuzzy matches, application to data models happens
 elsewhere.
 
 """
+from array import array
+from collections import OrderedDict, deque
+import copy
+import csv
 import datetime
+import hashlib
+import io
+import itertools
 import mmap
 import operator
 import sys
 
 from unicodecsv import DictReader, Sniffer
 import unicodedata
-from xlrd import XLRDError, open_workbook, xldate_as_tuple, empty_cell
+from xlrd import open_workbook, xldate_as_tuple, empty_cell
 
-from mcm import mapper, utils
+from mcm import cleaners, compressed, formats, mapper, sinks, utils, xlsx
 
 # from xlrd/biffh.py
 (
@@ -30,6 +37,79 @@ from mcm import mapper, utils
     XL_CELL_BLANK,  # for use in debugging, gathering stats, etc
 ) = range(7)
 
+# How many rows from the top of a sheet may hold its header row.
+HEADER_ROWS = 100
+# How many rows' existing models ``MCMParser.map_rows`` looks up at once.
+LOOKUP_SIZE = 1000
+# How much of a CSV file's rows to sniff its dialect from; as many whole
+# rows as it takes to reach, and always at least one.
+SNIFF_BYTES = 16384
+# How many sniffed dialects we remember, by the header they came with.
+MAX_CACHED_DIALECTS = 256
+
+_dialects = {}
+
+
+def _map_file(f):
+    """Memory map of the file f, or its contents if it can't be mapped,
+    e.g. if it's in memory anyway."""
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, IOError, ValueError):
+        f.seek(0)
+        return f.read()
+
+
+def _header_names(ontology):
+    """Lowercased column names of ontology, for spotting header rows.
+
+    :param ontology: dict with ``flat_schema``, or any iterable of names.
+    :rtype: frozenset
+
+    """
+    if not ontology:
+        return frozenset()
+    if isinstance(ontology, dict):
+        ontology = ontology.get(u'flat_schema', ontology)
+
+    return frozenset(unicode(name).strip().lower() for name in ontology)
+
+
+def find_header_row(rows, ncols, names=frozenset()):
+    """Pick the row most likely to be a sheet's header.
+
+    Each row scores a point per cell which is filled in, another if that's
+    text, and another if the text is one of names. The first of the best
+    scoring rows wins; we stop looking once a row can't be beaten.
+
+    :param rows: iterable of (types, values) for each row, from the top.
+    :param ncols: int, the number of columns in the sheet.
+    :param names: (optional) frozenset, lowercased ontology column names.
+    :returns: tuple, (index, (types, values)) of the header row; (0, None)
+        if there are no rows.
+
+    """
+    points = 3 if names else 2
+    best, best_score = (0, None), -1
+    for i, (types, values) in enumerate(rows):
+        filled = ncols - types.count(XL_CELL_EMPTY)
+        # Text, and text which is a name, can only score as much again.
+        if filled * points <= best_score:
+            continue
+        score = filled + types.count(XL_CELL_TEXT)
+        if names:
+            score += sum(
+                1 for ctype, value in zip(types, values)
+                if ctype == XL_CELL_TEXT and value
+                and value.strip().lower() in names
+            )
+        if score > best_score:
+            best, best_score = (i, (types, values)), score
+        if score == ncols * points:
+            break
+
+    return best
+
 
 class ExcelParser(object):
     """MS Excel (.xls, .xlsx) file parser for MCMParser
@@ -44,39 +124,101 @@ class ExcelParser(object):
             reader.seek_to_beginning()
             # rows.next() will return the first row
     """
-    def __init__(self, excel_file, *args, **kwargs):
+    def __init__(self, excel_file, sheet_index=0, *args, **kwargs):
         self.excel_file = excel_file
-        self.sheet = self._get_sheet(excel_file)
+        self.sheet_index = sheet_index
+        self.header_rows = kwargs.get('header_rows', HEADER_ROWS)
+        self.header_names = _header_names(kwargs.get('ontology'))
+        self._kwargs = kwargs
+        self.converters = self._get_converters()
+        self.sheet = self._get_sheet(
+            excel_file, sheet_index, workbook=kwargs.get('workbook')
+        )
         self.header_row = self._get_header_row(self.sheet)
         self.excelreader = self.XLSDictReader(self.sheet, self.header_row)
 
-    def _get_sheet(self, f, sheet_index=0):
+    def _get_sheet(self, f, sheet_index=0, workbook=None):
         """returns a xlrd sheet
 
         :param f: an open file of type ``file``
         :param sheet_index: the excel sheet with a 0-index
+        :param workbook: (optional) the xlrd Book already opened from f
         :returns: xlrd Sheet
         """
-        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
-        book = open_workbook(file_contents=data, on_demand=True)
-        self._workbook = book  # needed to determine datemode
-        return book.sheet_by_index(sheet_index)
+        if workbook is None:
+            data = _map_file(f)
+            # Sheets are only loaded as they're asked for.
+            workbook = open_workbook(file_contents=data, on_demand=True)
+        self._workbook = workbook  # needed to determine datemode
+        return workbook.sheet_by_index(sheet_index)
+
+    def num_sheets(self):
+        """number of sheets in the workbook"""
+        return self._workbook.nsheets
+
+    def sheet_names(self):
+        """names of the workbook's sheets, in order"""
+        return self._workbook.sheet_names()
+
+    def for_sheet(self, sheet_index):
+        """returns a parser for another sheet of the same workbook
+
+        The workbook isn't opened again, just the sheet loaded.
+        """
+        kwargs = dict(self._kwargs, workbook=self._workbook)
+        return type(self)(self.excel_file, sheet_index, **kwargs)
+
+    def unload(self):
+        """frees the memory held by this parser's sheet
+
+        The parser can't be read from afterwards.
+        """
+        self._workbook.unload_sheet(self.sheet_index)
 
     def _get_header_row(self, sheet):
         """returns the best guess for the header row
 
+        Only the first ``header_rows`` rows are considered; see
+        ``find_header_row``.
+
         :param sheet: xlrd sheet
         :returns: index of header row
         """
-        for row in range(sheet.nrows):
-            row_contains_empty_cells = False
-            for col in range(sheet.ncols):
-                if sheet.cell(row, col).ctype == empty_cell.ctype:
-                    row_contains_empty_cells = True
-            if not row_contains_empty_cells:
-                return row
-        # couldn't find a good row, return 0
-        return 0
+        rows = (
+            (sheet.row_types(i), sheet.row_values(i))
+            for i in range(min(sheet.nrows, self.header_rows))
+        )
+        return find_header_row(rows, sheet.ncols, self.header_names)[0]
+
+    def _convert_date(self, value):
+        # Thx to Augusto C Men to point fast solution for XLS/XLSX dates
+        try:
+            return datetime.datetime(
+                *xldate_as_tuple(value, self._workbook.datemode)
+            )
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _convert_number(value):
+        if value % 1 == 0:  # integers
+            return int(value)
+        return value
+
+    @staticmethod
+    def _convert_other(value):
+        if isinstance(value, unicode):
+            return unicodedata.normalize('NFKD', value).encode(
+                'ascii', 'ignore'
+            )
+        return value
+
+    def _get_converters(self):
+        """cell type -> function converting values of cells of that type"""
+        return {
+            XL_CELL_DATE: self._convert_date,
+            XL_CELL_NUMBER: self._convert_number,
+        }
 
     def get_value(self, item, **kwargs):
         """Handle different value types for XLS.
@@ -84,28 +226,23 @@ class ExcelParser(object):
         :param item: xlrd cell object
         :returns: items value with dates parsed properly
         """
+        convert = self.converters.get(item.ctype, self._convert_other)
+        return convert(item.value)
 
-        # Thx to Augusto C Men to point fast solution for XLS/XLSX dates
-        if item.ctype == XL_CELL_DATE:
-            try:
-                return datetime.datetime(
-                    *xldate_as_tuple(item.value, self._workbook.datemode)
-                )
-            except ValueError:
-                return None
-
-        if item.ctype == XL_CELL_NUMBER:
-            if item.value % 1 == 0:  # integers
-                return int(item.value)
-            else:
-                return item.value
-
-        if isinstance(item.value, unicode):
-            return unicodedata.normalize('NFKD', item.value).encode(
-                'ascii', 'ignore'
-            )
+    def convert_row(self, types, values, converters=None):
+        """Convert a whole row's values at once, as ``get_value`` would.
 
-        return item.value
+        :param types: list of xlrd cell types, e.g. ``sheet.row_types(i)``
+        :param values: list of raw values, e.g. ``sheet.row_values(i)``
+        :param converters: (optional) dict, cell type -> converter.
+        :returns: list of values with dates parsed properly
+        """
+        get_converter = (converters or self.converters).get
+        convert_other = self._convert_other
+        return [
+            get_converter(ctype, convert_other)(value)
+            for ctype, value in zip(types, values)
+        ]
 
     def XLSDictReader(self, sheet, header_row=0):
         """returns a generator yeilding a dict per row from the XLS/XLSX file
@@ -115,18 +252,22 @@ class ExcelParser(object):
         :param header_row: the row index to start with
         :returns: Generator yeilding a row as Dict
         """
-        def item(i, j):
-            """returns a tuple (column header, cell value)"""
-            return (
-                self.get_value(sheet.cell(header_row, j)),
-                self.get_value(sheet.cell(i, j))
-            )
+        header = ()
+        if header_row < sheet.nrows:
+            # Header values are only converted the once.
+            header = tuple(self.convert_row(
+                sheet.row_types(header_row), sheet.row_values(header_row)
+            ))
+        converters = self.converters
+        convert_row = self.convert_row
 
         # return a generator, using yield here wouldn't run until the first
         # usage causing the try/except in MCMParser _get_reader to return
         # ExcelReader for csv files
         return (
-            dict(item(i, j) for j in range(sheet.ncols))
+            dict(zip(header, convert_row(
+                sheet.row_types(i), sheet.row_values(i), converters
+            )))
             for i in range(header_row + 1, sheet.nrows)
         )
 
@@ -155,6 +296,88 @@ class ExcelParser(object):
         return self.sheet.row_values(self.header_row)
 
 
+class XLSXParser(ExcelParser):
+    """Streaming MS Excel 2007+ (.xlsx) file parser for MCMParser
+
+    Gives the same rows as ``ExcelParser``, but reads the sheet a row at a
+    time rather than loading it whole, so memory use doesn't grow with the
+    size of the file.
+
+    usage:
+            f = open('data.xlsx', 'rb')
+            reader = MCMParser(f)
+            rows = reader.next()
+            for row in rows:
+                # something with the row dict
+    """
+    def __init__(self, excel_file, sheet_index=0, *args, **kwargs):
+        self.excel_file = excel_file
+        self.sheet_index = sheet_index
+        self.header_rows = kwargs.get('header_rows', HEADER_ROWS)
+        self.header_names = _header_names(kwargs.get('ontology'))
+        self._kwargs = kwargs
+        self._workbook = (
+            kwargs.get('workbook') or xlsx.XLSXWorkbook(excel_file)
+        )
+        self.converters = self._get_converters()
+        self.ncols = self._workbook.ncols(sheet_index)
+        self.header_row, self._header = self._get_header_row()
+        self.excelreader = self.XLSDictReader()
+
+    def _rows(self):
+        """Generator yielding each row up to the last with values in it, as
+        (types, values) lists of ``ncols`` cells, like xlrd's padded rows."""
+        ncols = self.ncols
+        next_rowx = 0
+        for rowx, cells in self._workbook.iter_rows(self.sheet_index):
+            # Rows without values are only there if later ones have some.
+            for blank in range(next_rowx, rowx):
+                yield [XL_CELL_EMPTY] * ncols, [empty_cell.value] * ncols
+            next_rowx = rowx + 1
+            row = [cells.get(j, empty_cell) for j in range(ncols)]
+            yield [cell.ctype for cell in row], [cell.value for cell in row]
+
+    def _get_header_row(self):
+        """returns the best guess for the header row, and its values
+
+        As ``ExcelParser``, only reading as far as ``header_rows`` rows.
+        """
+        rows = itertools.islice(self._rows(), self.header_rows)
+        header_row, header = find_header_row(
+            rows, self.ncols, self.header_names
+        )
+        return header_row, header or ([], [])
+
+    def XLSDictReader(self):
+        """returns a generator yielding a dict per row after the header"""
+        header = tuple(self.convert_row(*self._header))
+        converters = self.converters
+        convert_row = self.convert_row
+        return (
+            dict(zip(header, convert_row(types, values, converters)))
+            for i, (types, values) in enumerate(self._rows())
+            if i > self.header_row
+        )
+
+    def seek_to_beginning(self):
+        """seeks to the beginning of the file
+
+        The sheet is read again from the start.
+        """
+        self.excelreader = self.XLSDictReader()
+
+    def unload(self):
+        """Nothing to free; only the row being read is ever in memory."""
+
+    def num_columns(self):
+        """gets the number of columns for the file"""
+        return self.ncols
+
+    def headers(self):
+        """original ordered list of spreadsheet headers"""
+        return list(self._header[1])
+
+
 class CSVParser(object):
     """CSV (.csv) file parser for MCMParser
 
@@ -176,16 +399,62 @@ class CSVParser(object):
         self.csvreader = self._get_csv_reader(csvfile, **kwargs)
         self.clean_super_scripts()
 
-    def _get_csv_reader(self, *args, **kwargs):
-        """Guess CSV dialect, and return CSV reader."""
-        # Skip the first line, as csv headers are more likely to have weird
+    def _sniff_dialect(self):
+        """Guess CSV dialect, raising ``csv.Error`` if it isn't CSV.
+
+        Files with a header we've seen before get the dialect it came with
+        last time, without sniffing.
+        """
+        try:
+            header = self.csvfile.readline()
+            key = hashlib.sha1(header).digest()
+            dialect = _dialects.get(key)
+            if dialect is None:
+                dialect = self._sniff_rows(header, self._sample_rows())
+                if len(_dialects) >= MAX_CACHED_DIALECTS:
+                    _dialects.clear()
+                _dialects[key] = dialect
+        finally:
+            self.csvfile.seek(0)
+
+        return dialect
+
+    def _sample_rows(self):
+        """Lines following the header, up to ``SNIFF_BYTES`` of them.
+
+        Lines are only ever read whole. MCM is often run on very wide csv
+        files, whose rows may be longer than the budget by themselves.
+        """
+        lines = []
+        size = 0
+        for line in iter(self.csvfile.readline, ''):
+            lines.append(line)
+            size += len(line)
+            if size >= SNIFF_BYTES:
+                break
+
+        return lines
+
+    def _sniff_rows(self, header, lines):
+        """Guess the dialect of the header and lines of a CSV file.
+
+        Comma separated, double quoted files are by far the most common, so
+        if that reads every line into as many fields as the header, that's
+        the dialect. Otherwise it's up to ``Sniffer``.
+        """
+        width = len(next(csv.reader([header]), []))
+        if width > 1 and all(
+            len(row) == width for row in csv.reader(lines) if row
+        ):
+            return csv.excel
+
+        # Only the rows, as csv headers are more likely to have weird
         # character distributions than the actual data.
-        self.csvfile.readline()
+        return Sniffer().sniff(''.join(lines))
 
-        # Read a significant chunk of the data to improve the odds of
-        # determining the dialect.  MCM is often run on very wide csv files.
-        dialect = Sniffer().sniff(self.csvfile.read(16384))
-        self.csvfile.seek(0)
+    def _get_csv_reader(self, *args, **kwargs):
+        """Guess CSV dialect, and return CSV reader."""
+        dialect = self._sniff_dialect()
 
         if 'reader_type' not in kwargs:
             return DictReader(self.csvfile, errors='replace')
@@ -239,6 +508,597 @@ class CSVParser(object):
         return self.csvreader.fieldnames
 
 
+class CSVRow(object):
+    """A row of a CSV file which reads like the dict ``CSVParser`` gives,
+    without the cost of building one.
+
+    Rows of a file share their header through a subclass made by
+    ``row_class``; each row just holds its tuple of values.
+    """
+    __slots__ = ('_values',)
+    # header names in order, duplicates dropped; name -> value position
+    fields = ()
+    index = {}
+    # number of names in the header, and whether it has no duplicates
+    width = 0
+    simple = True
+
+    def __init__(self, values):
+        self._values = values
+
+    @classmethod
+    def row_class(cls, header):
+        """Make the row class for a file with header, a list of names."""
+        positions = dict((name, i) for i, name in enumerate(header))
+        fields = tuple(OrderedDict.fromkeys(header))
+        return type(cls.__name__, (cls,), {
+            '__slots__': (),
+            'fields': fields,
+            'index': positions,
+            'width': len(header),
+            'simple': len(fields) == len(header),
+        })
+
+    def _extra(self):
+        """Values past the end of the header, as ``DictReader`` gives them
+        under None."""
+        return list(self._values[self.width:])
+
+    def __getitem__(self, key):
+        if key is None:
+            extra = self._extra()
+            if extra:
+                return extra
+            raise KeyError(key)
+        i = self.index[key]
+        return self._values[i] if i < len(self._values) else None
+
+    def __iter__(self):
+        for field in self.fields:
+            yield field
+        if self._extra():
+            yield None
+
+    def __len__(self):
+        return len(self.fields) + bool(self._extra())
+
+    def __contains__(self, key):
+        return key in self.index or (key is None and bool(self._extra()))
+
+    def items(self):
+        values = self._values
+        if self.simple and len(values) == self.width:
+            return zip(self.fields, values)
+        return [(key, self[key]) for key in self]
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [value for key, value in self.items()]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __eq__(self, other):
+        if not isinstance(other, (dict, CSVRow)):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(type(self).__name__, dict(self.items()))
+
+    def __reduce__(self):
+        # Row classes are made on the fly, so rows pickle as plain dicts,
+        # e.g. to go to a process pool.
+        return dict, (self.items(),)
+
+    def tuple(self):
+        """the row's values, in file order"""
+        return self._values
+
+
+class FastCSVParser(CSVParser):
+    """CSV (.csv) file parser for MCMParser, built for speed.
+
+    Gives the same rows as ``CSVParser``, but as ``CSVRow`` objects rather
+    than dicts, and reads them with the C ``csv.reader``; each row is
+    decoded in one go rather than field by field. ``tuples`` skips making
+    rows altogether. Use it with ``MCMParser(f, engine='fast')``.
+
+    usage:
+            f = open('data.csv', 'rb')
+            parser = FastCSVParser(f)
+            for values in parser.tuples():
+                values[parser.header_index[u'Property Id']]
+    """
+    encoding = 'utf-8'
+
+    def __init__(self, csvfile, *args, **kwargs):
+        self.csvfile = csvfile
+        self.dialect = self._sniff_dialect()
+        self._start()
+        self.clean_super_scripts()
+
+    def _start(self):
+        """Read the file from the start; the header first."""
+        self.csvfile.seek(0)
+        self.csvreader = csv.reader(self.csvfile)
+        try:
+            self.fieldnames = self._decode(next(self.csvreader))
+        except StopIteration:
+            self.fieldnames = []
+
+    def _decode(self, row):
+        """Decode a whole row of byte strings with a single call."""
+        # The csv module rejects NUL bytes, so they can't be in a field.
+        return tuple(
+            '\x00'.join(row).decode(self.encoding, 'replace').split(u'\x00')
+        )
+
+    def clean_super_scripts(self):
+        """Replaces column names with clean ones."""
+        self.unicode_fieldnames = [
+            self._clean_super(col) for col in self.fieldnames
+        ]
+        self.row_class = CSVRow.row_class(self.unicode_fieldnames)
+        self.header_index = self.row_class.index
+
+    def tuples(self):
+        """Generator yielding each row as a tuple of values.
+
+        Look values up by column name with ``header_index``.
+        """
+        decode = self._decode
+        for row in self.csvreader:
+            # Blank lines are skipped, as by ``DictReader``.
+            if row:
+                yield decode(row)
+
+    def next(self):
+        """Generator yielding each row as a ``CSVRow``."""
+        row_class = self.row_class
+        for values in self.tuples():
+            yield row_class(values)
+
+    def column_batches(self, size):
+        """Generator of batches of rows, each pivoted into columns.
+
+        Batches are pivoted straight from the rows' tuples, unless some
+        rows are short or long, when they're pivoted as ``CSVRow``s.
+
+        :param size: int, rows per batch.
+        :returns: Generator yielding dicts of column name -> list of values.
+
+        """
+        width = self.row_class.width
+        index = self.row_class.index.items()
+        for batch in utils.batch(self.tuples(), size):
+            if any(len(values) != width for values in batch):
+                yield utils.rows_to_columns(map(self.row_class, batch))
+                continue
+
+            columns = zip(*batch)
+            yield dict((name, list(columns[i])) for name, i in index)
+
+    def seek_to_beginning(self):
+        """seeks to the beginning of the file"""
+        self._start()
+
+    def num_columns(self):
+        """gets the number of columns for the file"""
+        return len(self.unicode_fieldnames)
+
+    def headers(self):
+        """original ordered list of spreadsheet headers"""
+        return list(self.fieldnames)
+
+
+class _Lines(object):
+    """Iterator over the lines of data[pos:end], keeping track of how far
+    it has got, so that each record ``csv.reader`` takes off it can be
+    located in data."""
+    def __init__(self, data, pos, end):
+        self.data = data
+        self.pos = pos
+        self.end = end
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        start = self.pos
+        if start >= self.end:
+            raise StopIteration
+        newline = self.data.find('\n', start, self.end)
+        self.pos = self.end if newline == -1 else newline + 1
+        return self.data[start:self.pos]
+
+
+class MappedCSVParser(FastCSVParser):
+    """``FastCSVParser`` over a memory map of the file, which can be split
+    up into readers of its own over any range of rows.
+
+    Rows are located by the byte offset they start at, found in one pass
+    of ``csv.reader`` over the file, so quoted newlines are no trouble. A
+    reader over some of the rows starts straight at them, without reading
+    the ones before. Use it with ``MCMParser(f, engine='mmap')``.
+
+    usage:
+            f = open('data.csv', 'rb')
+            parser = MappedCSVParser(f)
+            parser.num_rows()
+            for row in parser.for_rows(1000, 2000).next():
+                # something with the row
+            # or, in another process, given parser.byte_ranges(1000)
+            MappedCSVParser(open('data.csv', 'rb'), byte_range=(begin, end))
+    """
+    def __init__(self, csvfile, *args, **kwargs):
+        self.csvfile = csvfile
+        self.dialect = self._sniff_dialect()
+        self.data = _map_file(csvfile)
+        lines = _Lines(self.data, 0, len(self.data))
+        try:
+            self.fieldnames = self._decode(next(csv.reader(lines)))
+        except StopIteration:
+            self.fieldnames = []
+        # Where this reader's rows are in the file; all of them by default.
+        self.begin, self.end = (
+            kwargs.get('byte_range') or (lines.pos, len(self.data))
+        )
+        self._row_index = None
+        self._start()
+        self.clean_super_scripts()
+
+    def _start(self):
+        """Read this reader's rows from the first."""
+        self.csvreader = csv.reader(_Lines(self.data, self.begin, self.end))
+
+    @property
+    def row_index(self):
+        """array of the byte offset each row starts at, then the end offset
+
+        Built on first use, by a pass over the rows.
+        """
+        if self._row_index is None:
+            lines = _Lines(self.data, self.begin, self.end)
+            index = array('L')
+            start = lines.pos
+            for row in csv.reader(lines):
+                # Blank lines aren't rows, as they're skipped.
+                if row:
+                    index.append(start)
+                start = lines.pos
+            index.append(self.end)
+            self._row_index = index
+
+        return self._row_index
+
+    def num_rows(self):
+        """number of rows read by this reader"""
+        return len(self.row_index) - 1
+
+    def byte_range(self, start=0, stop=None):
+        """returns the (begin, end) byte offsets of rows start to stop
+
+        :param start: int, first row, from 0.
+        :param stop: (optional) int, row to stop before; by default the end.
+        :rtype: tuple of int, for ``MappedCSVParser(f, byte_range=...)``.
+
+        """
+        num_rows = self.num_rows()
+        start = min(start, num_rows)
+        stop = num_rows if stop is None else min(max(stop, start), num_rows)
+        return self.row_index[start], self.row_index[stop]
+
+    def byte_ranges(self, chunk_size):
+        """returns the byte ranges of consecutive chunks of chunk_size rows
+
+        :rtype: list of (begin, end) tuples, as given by ``byte_range``.
+
+        """
+        return [
+            self.byte_range(start, start + chunk_size)
+            for start in range(0, self.num_rows(), chunk_size)
+        ]
+
+    def for_rows(self, start, stop=None):
+        """returns a reader of rows start to stop of this one's
+
+        It shares this reader's memory map and header, but is read
+        independently of it.
+        """
+        parser = copy.copy(self)
+        parser.begin, parser.end = self.byte_range(start, stop)
+        parser._row_index = None
+        parser._start()
+        return parser
+
+
+class _NeedMore(Exception):
+    """The stream ran out partway through a record."""
+
+
+class _LineFeed(object):
+    """Lines for ``csv.reader`` as they arrive off a stream.
+
+    Running out partway through a record raises ``_NeedMore`` rather than
+    ending it, and ``rewind`` puts the record's lines back to be read again
+    once the rest of it has arrived.
+    """
+    def __init__(self):
+        self.lines = deque()
+        self.record = []
+        self.closed = False
+        # bytes of lines waiting to be read
+        self.size = 0
+
+    def __iter__(self):
+        return self
+
+    def extend(self, lines):
+        for line in lines:
+            self.lines.append(line)
+            self.size += len(line)
+
+    def next(self):
+        if not self.lines:
+            if self.closed:
+                raise StopIteration
+            raise _NeedMore()
+        line = self.lines.popleft()
+        self.size -= len(line)
+        self.record.append(line)
+        return line
+
+    def rewind(self):
+        for line in reversed(self.record):
+            self.lines.appendleft(line)
+            self.size += len(line)
+        self.record = []
+
+
+class CSVStreamParser(FastCSVParser):
+    """CSV parser for a stream of bytes, taken a chunk at a time as it
+    arrives, so no file is needed.
+
+    Rows are parsed as soon as they're complete, and are the ``CSVRow``s
+    ``FastCSVParser`` would give. Chunks can be pushed in with ``feed``,
+    e.g. from an event loop's callbacks, or pulled from any iterable of byte
+    strings given to the parser, as ``MCMParser(chunks, engine='stream')``.
+    Streams aren't sniffed, and can only be read once.
+
+    usage:
+            parser = CSVStreamParser()
+            def on_chunk(data):
+                for row in parser.feed(data):
+                    # something with the row
+            def on_end():
+                parser.close()  # the rest of the rows
+
+            # or
+            parser = CSVStreamParser(iter(lambda: body.read(65536), ''))
+            parser.headers()
+            for row in parser.next():
+                # something with the row
+    """
+    def __init__(self, chunks=None, *args, **kwargs):
+        self.chunks = iter(chunks or ())
+        self.fieldnames = None
+        self._pending = []
+        self._lines = _LineFeed()
+        self.csvreader = csv.reader(self._lines)
+        # How many bytes of lines to wait for before parsing again, after
+        # running out partway through a record.
+        self._wait_for = 0
+        # Rows that came along with the header.
+        self._ready = []
+        for chunk in self.chunks:
+            self._ready.extend(self.feed(chunk))
+            if self.fieldnames is not None:
+                break
+        # Chunks that run out before the header's end are the whole stream.
+        if chunks is not None and self.fieldnames is None:
+            self._ready.extend(self.close())
+
+    def feed(self, data):
+        """Parse data, the next chunk of the stream.
+
+        :param data: str, bytes of the stream.
+        :returns: list of ``CSVRow``, the rows it completes.
+
+        """
+        # Only whole lines are parsed; the rest waits for its end.
+        end = data.rfind('\n') + 1
+        if not end:
+            self._pending.append(data)
+            return []
+
+        self._pending.append(data[:end])
+        lines = ''.join(self._pending).split('\n')
+        self._pending = [data[end:]]
+        self._lines.extend(line + '\n' for line in lines[:-1])
+        # A record spread over many chunks is parsed from its start each
+        # time, so only try again once twice as much of it is in.
+        if self._lines.size < self._wait_for:
+            return []
+        return self._parse()
+
+    def close(self):
+        """Parse the end of the stream.
+
+        :returns: list of ``CSVRow``, the rows it completes.
+
+        """
+        self._lines.closed = True
+        tail = ''.join(self._pending)
+        self._pending = []
+        if tail:
+            self._lines.extend([tail])
+        rows = self._parse()
+        if self.fieldnames is None:
+            self.fieldnames = ()
+            self.clean_super_scripts()
+
+        return rows
+
+    def _parse(self):
+        """Parse all the complete records we have lines for."""
+        rows = []
+        decode = self._decode
+        while 1:
+            try:
+                values = next(self.csvreader)
+            except _NeedMore:
+                self._lines.rewind()
+                self._wait_for = 2 * self._lines.size
+                break
+            except StopIteration:
+                break
+
+            self._lines.record = []
+            if self.fieldnames is None:
+                self.fieldnames = decode(values)
+                self.clean_super_scripts()
+            # Blank lines are skipped, as by ``DictReader``.
+            elif values:
+                rows.append(self.row_class(decode(values)))
+
+        return rows
+
+    def tuples(self):
+        """Generator yielding each row as a tuple of values."""
+        for row in self.next():
+            yield row.tuple()
+
+    def next(self):
+        """Generator yielding each row of the stream as a ``CSVRow``."""
+        ready, self._ready = self._ready, []
+        for row in ready:
+            yield row
+        for chunk in self.chunks:
+            for row in self.feed(chunk):
+                yield row
+        for row in self.close():
+            yield row
+
+    def seek_to_beginning(self):
+        """streams can't go back to the beginning"""
+        raise IOError('A stream can only be read once')
+
+
+# Parsers for CSV files, by the ``engine`` name given to ``MCMParser``.
+CSV_ENGINES = {
+    'default': CSVParser,
+    'fast': FastCSVParser,
+    'mmap': MappedCSVParser,
+    'stream': CSVStreamParser,
+}
+
+
+def _csv_reader(import_file, engine='default', byte_range=None, **kwargs):
+    """Parser for a CSV file, by the ``CSV_ENGINES`` engine named."""
+    csv_kwargs = {}
+    if byte_range is not None:
+        csv_kwargs['byte_range'] = byte_range
+    return CSV_ENGINES[engine](import_file, **csv_kwargs)
+
+
+def _stream_reader(stream, **kwargs):
+    """Parser for a ``compressed.StreamFile`` of any format.
+
+    CSV files are read as they're decompressed. Workbooks and archives
+    are read into memory first, as they can only be read out of order.
+    """
+    if formats.detect_format(stream) in RANDOM_ACCESS_FORMATS:
+        stream = io.BytesIO(stream.read())
+
+    return open_reader(stream, **kwargs)
+
+
+def _gzip_reader(import_file, **kwargs):
+    """Parser for the file compressed in a gzip file."""
+    return _stream_reader(compressed.gzip_file(import_file), **kwargs)
+
+
+def _bz2_reader(import_file, **kwargs):
+    """Parser for the file compressed in a bz2 file."""
+    return _stream_reader(compressed.bz2_file(import_file), **kwargs)
+
+
+def _utf16_reader(import_file, **kwargs):
+    """Parser for a UTF-16 text file, read as UTF-8."""
+    return _stream_reader(
+        compressed.utf8_file(import_file, 'utf-16'), **kwargs
+    )
+
+
+def _utf8_sig_reader(import_file, **kwargs):
+    """Parser for a UTF-8 text file starting with a byte order mark, read
+    without it."""
+    return _stream_reader(
+        compressed.utf8_file(import_file, 'utf-8-sig'), **kwargs
+    )
+
+
+def _zip_reader(import_file, member=None, **kwargs):
+    """Parser for a file in a zip archive, by default the first."""
+    return _stream_reader(
+        compressed.zip_member_file(import_file, member or 0), **kwargs
+    )
+
+
+# Parsers for each format ``formats.detect_format`` can tell apart. Each is
+# called with the file and the keyword arguments ``MCMParser`` was given
+# for its reader, and ignores those it has no use for.
+FORMAT_READERS = {
+    'xls': ExcelParser,
+    'xlsx': XLSXParser,
+    'csv': _csv_reader,
+    'gzip': _gzip_reader,
+    'bz2': _bz2_reader,
+    'zip': _zip_reader,
+    'utf-16': _utf16_reader,
+    'utf-8-sig': _utf8_sig_reader,
+}
+# Formats which can't be read from a stream.
+RANDOM_ACCESS_FORMATS = frozenset(['xls', 'xlsx', 'zip'])
+
+
+def open_reader(import_file, **kwargs):
+    """returns the ``FORMAT_READERS`` reader for the file's format, or
+    raises an exception
+
+    :param kwargs: (optional) sheet_index, the spreadsheet sheet to
+        read; header_rows and ontology, to help spot its header row;
+        engine, the name of the ``CSV_ENGINES`` parser for CSV files;
+        byte_range, the part of a CSV file to read with engine 'mmap';
+        member, the name or index of the file to read in a zip archive.
+    """
+    engine = CSV_ENGINES[kwargs.get('engine', 'default')]
+    if issubclass(engine, CSVStreamParser):
+        # Streams can't be looked into for their format.
+        return engine(import_file)
+
+    file_format = formats.detect_format(import_file)
+    if file_format not in FORMAT_READERS:
+        raise Exception('Cannot parse {0} files'.format(file_format))
+
+    return FORMAT_READERS[file_format](import_file, **kwargs)
+
+
 class MCMParser(object):
     """
     This Parser is a wrapper around CSVReader and ExcelParser which matches
@@ -259,9 +1119,36 @@ class MCMParser(object):
             reader.seek_to_beginning()
             # rows.next() will return the first row
 
+    Spreadsheet header rows are easier to spot given the ontology they're
+    to be mapped to, e.g. ``MCMParser(f, ontology=espm_ontology)``; only the
+    first ``header_rows`` rows are considered. CSV files are read with
+    ``CSV_ENGINES[engine]``, e.g. ``MCMParser(f, engine='fast')``. With
+    ``engine='mmap'``, ``byte_range`` reads just the rows between two byte
+    offsets, as given by ``MappedCSVParser.byte_ranges``. With
+    ``engine='stream'``, import_file is an iterable of chunks of a CSV file
+    rather than a file; see ``CSVStreamParser``.
+
+    gzip and bz2 files are decompressed as they're read, as are the files
+    in zip archives; ``member`` picks which one, by default the first, and
+    ``members`` gives a parser for each.
+
     """
     def __init__(self, import_file, *args, **kwargs):
-        self.reader = self._get_reader(import_file)
+        # Everything needed to open the file again for any of its sheets.
+        self.reader_kwargs = {
+            'header_rows': kwargs.get('header_rows', HEADER_ROWS),
+            'ontology': kwargs.get('ontology'),
+            'engine': kwargs.get('engine', 'default'),
+            'byte_range': kwargs.get('byte_range'),
+            'member': kwargs.get('member'),
+        }
+        # Looked for first, while import_file is still at its start.
+        self._member_names = self._get_member_names(import_file)
+        self.reader = self._get_reader(
+            import_file,
+            sheet_index=kwargs.get('sheet_index', 0),
+            **self.reader_kwargs
+        )
         self.import_file = import_file
         if 'matching_func' not in kwargs:
             # Special note, contains expects argumengs like the following
@@ -271,8 +1158,112 @@ class MCMParser(object):
         else:
             self.matching_func = kwargs.get('matching_func')
 
+    def sheet_names(self):
+        """names of the workbook's sheets; CSV files have none"""
+        if isinstance(self.reader, ExcelParser):
+            return self.reader.sheet_names()
+        return []
+
+    def sheets(self):
+        """Generator yielding an ``MCMParser`` for each sheet, in turn.
+
+        Each sheet is only loaded when its parser is yielded, and unloaded
+        again once we move on to the next, so just one is ever in memory.
+        CSV files are a single sheet, this parser.
+
+        usage:
+                for sheet in MCMParser(f).sheets():
+                    for m in sheet.map_rows(mapping, model_class):
+                        m.save()
+        """
+        if not isinstance(self.reader, ExcelParser):
+            yield self
+            return
+
+        for sheet_index in range(self.reader.num_sheets()):
+            sheet = copy.copy(self)
+            sheet.reader = self.reader.for_sheet(sheet_index)
+            yield sheet
+            sheet.reader.unload()
+
+    def _get_member_names(self, import_file):
+        """names of the files in import_file, if it's a zip archive"""
+        engine = CSV_ENGINES[self.reader_kwargs['engine']]
+        if issubclass(engine, CSVStreamParser):
+            return []
+        if formats.detect_format(import_file) != 'zip':
+            return []
+        return compressed.zip_members(import_file)
+
+    def member_names(self):
+        """names of the files in a zip archive; other files have none"""
+        return list(self._member_names)
+
+    def members(self):
+        """Generator yielding an ``MCMParser`` for each file in a zip
+        archive, in turn, each read straight out of the archive.
+
+        Other files are a single member, this parser.
+
+        usage:
+                for member in MCMParser(open('exports.zip', 'rb')).members():
+                    for sheet in member.sheets():
+                        # something with the sheet
+        """
+        if not self._member_names:
+            yield self
+            return
+
+        for name in self._member_names:
+            member = copy.copy(self)
+            member.reader_kwargs = dict(self.reader_kwargs, member=name)
+            member.reader = self._get_reader(
+                self.import_file, **member.reader_kwargs
+            )
+            yield member
+
+    def process_sheets(self, callback, executor=None):
+        """Call ``callback(sheet)`` with an ``MCMParser`` for each sheet.
+
+        :param callback: callable, given each sheet's parser.
+        :param executor: (optional) ``concurrent.futures`` style executor to
+            process sheets concurrently on. Each sheet's task opens the file
+            again by name and only loads its own sheet, so the file must be
+            on disk; for process pools, callback must be picklable, e.g. a
+            module level function.
+        :returns: list of callback's results, in sheet order.
+
+        """
+        if executor is None:
+            return [callback(sheet) for sheet in self.sheets()]
+
+        futures = [
+            executor.submit(
+                _process_sheet,
+                self.import_file.name,
+                sheet_index,
+                callback,
+                self.reader_kwargs,
+            )
+            for sheet_index in range(max(len(self.sheet_names()), 1))
+        ]
+        return [future.result() for future in futures]
+
+    def for_rows(self, start, stop=None):
+        """returns an ``MCMParser`` for rows start to stop of this one's
+
+        Only for ``engine='mmap'``; see ``MappedCSVParser.for_rows``.
+        """
+        parser = copy.copy(self)
+        parser.reader = self.reader.for_rows(start, stop)
+        return parser
+
     def split_rows(self, chunk_size, callback, *args, **kwargs):
-        """Break up the CSV into smaller pieces for parallel processing."""
+        """Break up the CSV into smaller pieces, calling
+        ``callback(batch, *args, **kwargs)`` on each in turn.
+
+        See ``process_rows`` for processing them in parallel.
+        """
         row_num = 0
         for batch in utils.batch(self.next(), chunk_size):
             row_num += len(batch)
@@ -280,27 +1271,165 @@ class MCMParser(object):
 
         return row_num
 
-    def map_rows(self, mapping, model_class):
+    def process_rows(
+        self,
+        chunk_size,
+        callback,
+        executor=None,
+        max_in_flight=None,
+        ordered=True
+    ):
+        """Call ``callback(batch)`` for batches of rows, on an executor.
+
+        Rows are read here while the executor processes earlier batches;
+        see ``utils.pipeline``. An error in one batch doesn't stop the rest.
+
+        usage:
+                with ThreadPoolExecutor(4) as executor:
+                    done = parser.process_rows(100, save, executor)
+                done.rows, done.results
+                done.raise_errors()
+
+        :param chunk_size: int, rows per batch.
+        :param callback: callable, given each list of rows. For process
+            pools it must be picklable, e.g. a module level function.
+        :param executor: (optional) ``concurrent.futures`` style executor;
+            without one, batches are processed one after another.
+        :param max_in_flight: (optional) int, most batches waiting on the
+            executor at once.
+        :param ordered: (optional) bool, collect results in batch order
+            rather than as they finish.
+        :returns: ``utils.BatchResults``, with each batch's result or error.
+
+        """
+        return utils.BatchResults(utils.pipeline(
+            utils.batch(self.next(), chunk_size),
+            callback,
+            executor=executor,
+            max_in_flight=max_in_flight,
+            ordered=ordered,
+        ))
+
+    def map_rows(
+        self,
+        mapping,
+        model_class,
+        key=None,
+        lookup=None,
+        lookup_size=LOOKUP_SIZE,
+        **kwargs
+    ):
         """Convenience method to call ``mapper.map_row`` on all rows.
 
+        Rows are mapped onto new models, unless given a key and lookup to
+        find existing ones by. Those are looked up for ``lookup_size`` rows
+        at a time, with one call; see ``mapper.MappingPlan.resolve``.
+
+        usage:
+                def lookup(keys):
+                    return Property.objects.filter(pm_property_id__in=keys)
+
+                for m in parser.map_rows(
+                    espm.MAP, Property, key='pm_property_id', lookup=lookup
+                ):
+                    m.save()
+
         :param mapping: dict, keys map columns to model_class attrs.
         :param model_class: class, reference to model class.
+        :param key: (optional) str, model attribute identifying a model,
+            e.g. ``pm_property_id``.
+        :param lookup: (optional) callable, given a list of keys, returns
+            the models that exist for them.
+        :param lookup_size: (optional) int, rows to look up models for
+            at once.
+        :param kwargs: (optional) any other ``mapper.compile_mapping``
+            arguments, e.g. cleaner, concat.
 
         """
-        for row in self.next():
-            # Figure out if this is an inser or update.
-            # e.g. model.objects.get('some canonical id') or model_class()
-            yield mapper.map_row(row, mapping, model_class)
+        plan = mapper.compile_mapping(mapping, model_class, **kwargs)
+        if lookup is None:
+            for row in self.next():
+                yield plan.map(row)
+            return
 
-    def _get_reader(self, import_file):
-        """returns a CSV or XLS/XLSX reader or raises an exception"""
-        try:
-            return ExcelParser(import_file)
-        except XLRDError as e:
-            if 'Unsupported format' in e.message:
-                return CSVParser(import_file)
-            else:
-                raise Exception('Cannot parse file')
+        for rows in utils.batch(self.next(), lookup_size):
+            for model in plan.map_batch(rows, key, lookup):
+                yield model
+
+    def column_batches(self, size):
+        """Generator of batches of rows, each pivoted into columns.
+
+        :param size: int, rows per batch.
+        :returns: Generator yielding dicts of column name -> list of values.
+
+        """
+        if isinstance(self.reader, FastCSVParser):
+            return self.reader.column_batches(size)
+
+        return (
+            utils.rows_to_columns(rows)
+            for rows in utils.batch(self.next(), size)
+        )
+
+    def iter_batches(self, size, ontology=None):
+        """Generator of batches of rows as numpy arrays, a column each.
+
+        Columns are cleaned, and typed by their types in the ontology;
+        see ``cleaners.column_array``. Needs numpy.
+
+        usage:
+                for batch in parser.iter_batches(10000, espm_ontology):
+                    numpy.nanmean(batch[u'Site EUI(kBtu/ft2)'])
+
+        :param size: int, rows per batch.
+        :param ontology: (optional) dict, with column name -> type under
+            ``types``; by default the one this parser was given, if any.
+        :returns: Generator yielding dicts of column name -> numpy array.
+
+        """
+        cleaner = cleaners.Cleaner(
+            ontology or self.reader_kwargs['ontology'] or {}
+        )
+        for columns in self.column_batches(size):
+            yield cleaner.clean_arrays(columns)
+
+    def map_batches(
+        self, mapping, model_class, size, key=None, lookup=None, **kwargs
+    ):
+        """Like ``map_rows``, but mapping and cleaning a column at a time.
+
+        :param size: int, rows per batch, and per lookup of existing models.
+        :returns: Generator yielding lists of models, one list per batch.
+
+        """
+        plan = mapper.compile_mapping(mapping, model_class, **kwargs)
+        for columns in self.column_batches(size):
+            yield plan.map_columns(columns, key=key, lookup=lookup)
+
+    def save_rows(self, mapping, model_class, sink=None, **kwargs):
+        """Map all rows, saving the models in batches through sink.
+
+        usage:
+                sink = sinks.SQLiteSink('import.db', 'buildings', columns)
+                parser.save_rows(espm.MAP, FakeModel, sink, flush_size=500)
+
+        :param sink: (optional) ``sinks.Sink``, by default one calling each
+            model's ``save``. It's closed once all rows are saved.
+        :param kwargs: (optional) any other ``map_rows`` arguments, e.g.
+            key, lookup, cleaner.
+        :returns: dict, the sink's ``stats()``.
+
+        """
+        if sink is None:
+            sink = sinks.Sink()
+        with sink:
+            sink.extend(self.map_rows(mapping, model_class, **kwargs))
+
+        return sink.stats()
+
+    def _get_reader(self, import_file, **kwargs):
+        """returns a reader for the file; see ``open_reader``"""
+        return open_reader(import_file, **kwargs)
 
     def next(self):
         """calls the reader's next"""
@@ -319,6 +1448,14 @@ class MCMParser(object):
         return self.reader.headers()
 
 
+def _process_sheet(path, sheet_index, callback, reader_kwargs):
+    """Worker for ``MCMParser.process_sheets``; opens path for one sheet."""
+    with open(path, 'rb') as f:
+        return callback(
+            MCMParser(f, sheet_index=sheet_index, **reader_kwargs)
+        )
+
+
 def main():
     """Just some contrived test code."""
     from mcm.mappings import espm
@@ -327,12 +1464,19 @@ def main():
     if len(sys.argv) < 2:
         sys.exit('You need to specify a CSV file path.')
 
+    sink = None
+    if len(sys.argv) > 2:
+        # Save to a sqlite file, rather than calling each model's save.
+        columns = sorted(set(espm.MAP.values())) + [u'extra_data']
+        sink = sinks.SQLiteSink(
+            sys.argv[2], u'buildings', columns, key=u'pm_property_id'
+        )
+
     with open(sys.argv[1], 'rb') as f:
         parser = MCMParser(f)
         mapping = espm.MAP
         model_class = FakeModel
-        for m in parser.map_rows(mapping, model_class):
-            m.save()
+        parser.save_rows(mapping, model_class, sink)
 
 
 if __name__ == '__main__':
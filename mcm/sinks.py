@@ -0,0 +1,202 @@
+"""
+:copyright: (c) 2014 Building Energy Inc
+:license: see LICENSE for more details.
+
+
+Saves mapped models in batches.
+
+Saving each model as it's mapped costs a round trip to the database per
+row. A ``Sink`` buffers models instead, and hands them to ``bulk_save``
+``flush_size`` at a time, timing each flush. ``SQLiteSink`` is a reference
+sink writing each flush with one ``executemany`` in one transaction.
+
+"""
+import json
+import sqlite3
+import time
+
+# How many models a sink buffers before saving them.
+FLUSH_SIZE = 1000
+
+
+class Sink(object):
+    """Buffers models, saving them ``flush_size`` at a time.
+
+    Subclasses, or the ``bulk_save`` argument, say how to save a list of
+    models; by default each one's ``save`` is called. Models still buffered
+    when the sink is closed are saved then.
+
+    usage:
+            def bulk_save(models):
+                Property.objects.bulk_create(models)
+
+            with Sink(bulk_save, flush_size=500) as sink:
+                sink.extend(parser.map_rows(espm.MAP, Property))
+            sink.stats()
+
+    :param bulk_save: (optional) callable, given a list of models, saves
+        them all.
+    :param flush_size: (optional) int, models to buffer between saves.
+
+    """
+    def __init__(self, bulk_save=None, flush_size=FLUSH_SIZE):
+        if bulk_save is not None:
+            self.bulk_save = bulk_save
+        self.flush_size = flush_size
+        self.flushes = 0
+        self.saved = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self._buffer = []
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            # Don't save the half of a batch that was mapped before failing.
+            del self._buffer[:]
+        self.close()
+
+    def bulk_save(self, models):
+        """Save the list of models."""
+        for model in models:
+            model.save()
+
+    def add(self, model):
+        """Buffer model, saving the buffer if that fills it."""
+        self._buffer.append(model)
+        if len(self._buffer) >= self.flush_size:
+            self.flush()
+
+    def extend(self, models):
+        """Buffer each of models in turn, e.g. those ``map_rows`` yields."""
+        for model in models:
+            self.add(model)
+
+    def flush(self):
+        """Save the buffered models now.
+
+        Should saving them fail, they stay buffered.
+
+        :returns: int, the number of models saved.
+
+        """
+        models = self._buffer
+        if not models:
+            return 0
+
+        start = time.time()
+        self.bulk_save(models)
+        elapsed = time.time() - start
+        self._buffer = []
+        self.flushes += 1
+        self.saved += len(models)
+        self.seconds += elapsed
+        self.max_seconds = max(self.max_seconds, elapsed)
+
+        return len(models)
+
+    def close(self):
+        """Save whatever is still buffered."""
+        self.flush()
+
+    def stats(self):
+        """Flush and model counts, with time spent saving them."""
+        return {
+            'flushes': self.flushes,
+            'saved': self.saved,
+            'buffered': len(self._buffer),
+            'seconds': self.seconds,
+            'max_seconds': self.max_seconds,
+            'mean_seconds': (
+                self.seconds / self.flushes if self.flushes else 0.0
+            ),
+        }
+
+
+def _quote(name):
+    return u'"{0}"'.format(name.replace(u'"', u'""'))
+
+
+def _db_value(value):
+    """value as sqlite can store it; dicts and lists as JSON."""
+    if isinstance(value, (dict, list, tuple)):
+        return json.dumps(value, default=unicode)
+    return value
+
+
+class SQLiteSink(Sink):
+    """Saves models' attributes as rows of a sqlite table.
+
+    Each flush is one ``executemany`` in one transaction. The table is made
+    if it doesn't exist; with a key, rows replace those with the same key.
+
+    usage:
+            columns = sorted(set(espm.MAP.values())) + ['extra_data']
+            with SQLiteSink('/tmp/import.db', 'buildings', columns,
+                            key='pm_property_id') as sink:
+                sink.extend(parser.map_rows(espm.MAP, FakeModel))
+
+    :param db: str, path of the sqlite file, or an open sqlite3 connection.
+    :param table: str, name of the table.
+    :param columns: list of str, model attributes to save, one per column.
+        Missing attributes are saved as NULL.
+    :param key: (optional) str, one of columns, the table's primary key.
+    :param flush_size: (optional) int, models to buffer between saves.
+
+    """
+    def __init__(
+        self, db, table, columns, key=None, flush_size=FLUSH_SIZE
+    ):
+        super(SQLiteSink, self).__init__(flush_size=flush_size)
+        self.table = table
+        self.columns = list(columns)
+        self.key = key
+        self._owns_connection = isinstance(db, basestring)
+        if self._owns_connection:
+            db = sqlite3.connect(db)
+        self.connection = db
+
+        definitions = [_quote(column) for column in self.columns]
+        if key is not None:
+            definitions.append(u'PRIMARY KEY ({0})'.format(_quote(key)))
+        with self.connection:
+            self.connection.execute(
+                u'CREATE TABLE IF NOT EXISTS {0} ({1})'.format(
+                    _quote(table), u', '.join(definitions)
+                )
+            )
+        self._insert = u'INSERT {0}INTO {1} ({2}) VALUES ({3})'.format(
+            u'OR REPLACE ' if key is not None else u'',
+            _quote(table),
+            u', '.join(_quote(column) for column in self.columns),
+            u', '.join(u'?' for column in self.columns),
+        )
+
+    def values(self, model):
+        """The row model is saved as."""
+        return [
+            _db_value(getattr(model, column, None))
+            for column in self.columns
+        ]
+
+    def bulk_save(self, models):
+        # Commits on success, rolls the whole batch back on failure.
+        with self.connection:
+            self.connection.executemany(
+                self._insert, [self.values(model) for model in models]
+            )
+
+    def close(self):
+        """Save whatever is still buffered, then close the connection if
+        the sink opened it."""
+        try:
+            super(SQLiteSink, self).close()
+        finally:
+            if self._owns_connection and self.connection is not None:
+                self.connection.close()
+                self.connection = None
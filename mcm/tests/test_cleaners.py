@@ -3,9 +3,12 @@
 :license: see LICENSE for more details.
 """
 import datetime
+import sys
 from unittest import TestCase
 from decimal import Decimal
 
+from concurrent.futures import ThreadPoolExecutor
+
 from mcm import cleaners
 
 
@@ -90,3 +93,167 @@ class TestCleaners(TestCase):
 
         self.assertEqual(self.cleaner.date_columns, ['heading2'])
         self.assertEqual(self.cleaner.float_columns, ['heading_data1'])
+
+    def test_clean_row(self):
+        """Every value in a row is cleaned according to its column."""
+        row = {
+            u'heading1': u'Not Available',
+            u'heading2': u'2/12/2012',
+            u'heading_data1': u'1,123.45',
+            u'unknown': u'Whatever',
+        }
+        self.assertEqual(
+            self.cleaner.clean_row(row),
+            {
+                u'heading1': None,
+                u'heading2': datetime.datetime(2012, 2, 12, 0, 0),
+                u'heading_data1': 1123.45,
+                u'unknown': u'Whatever',
+            }
+        )
+        unmemoized = cleaners.Cleaner(
+            self.cleaner.ontology, memo_size=0, infer_dates=False
+        )
+        self.assertEqual(
+            unmemoized.column_cleaners,
+            {
+                'heading_data1': cleaners.float_cleaner,
+                'heading2': cleaners.date_cleaner,
+            }
+        )
+
+    def test_memoized_cleaner(self):
+        """Repeated values are only cleaned once, and types aren't mixed."""
+        calls = []
+
+        def cleaner(value, *args):
+            calls.append(value)
+            return value
+
+        memo = cleaners.MemoizedCleaner(cleaner, max_size=2)
+        self.assertEqual(memo(u'1'), u'1')
+        self.assertEqual(memo(u'1'), u'1')
+        self.assertTrue(isinstance(memo(1.0), float))
+        self.assertTrue(isinstance(memo(1), int))
+        self.assertEqual(calls, [u'1', 1.0, 1])
+        self.assertEqual(len(memo), 2)
+
+        # Unhashable arguments just skip the memo.
+        self.assertEqual(memo(u'a', [u'a', u'b']), u'a')
+        self.assertEqual(memo(u'a', [u'a', u'b']), u'a')
+        self.assertEqual(len(calls), 5)
+        self.assertEqual(
+            memo.stats(),
+            {'hits': 1, 'misses': 3, 'size': 2, 'hit_rate': 0.25}
+        )
+
+    def test_memoized_cleaner_threads(self):
+        """A memo and a date parser can be shared by several threads."""
+        memo = cleaners.MemoizedCleaner(cleaners.float_cleaner, max_size=8)
+        parser = cleaners.DateParser(sample_size=64)
+        values = [unicode(i % 50) for i in range(2000)]
+        dates = [u'2/{0}/2012'.format(i % 28 + 1) for i in range(2000)]
+
+        def clean(i):
+            return memo(values[i]), parser(dates[i])
+
+        # Switch threads as often as possible.
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            executor = ThreadPoolExecutor(max_workers=8)
+            results = list(executor.map(clean, range(len(values))))
+            executor.shutdown()
+        finally:
+            sys.setcheckinterval(interval)
+
+        self.assertEqual(
+            results,
+            [
+                (float(value), cleaners.date_cleaner(date))
+                for value, date in zip(values, dates)
+            ]
+        )
+        self.assertEqual(memo.hits + memo.misses, len(values))
+        self.assertTrue(len(memo) <= 8)
+        self.assertEqual(parser.format, u'mdy')
+
+    def test_cleaner_memo_stats(self):
+        """A Cleaner shares memos across columns of the same type."""
+        for i in range(3):
+            self.cleaner.clean_value(u'2/12/2012', u'heading2')
+            self.cleaner.clean_value(u'0.7', u'heading_data1')
+
+        stats = self.cleaner.memo_stats()
+        self.assertEqual(stats['date_cleaner']['hits'], 2)
+        self.assertEqual(stats['float_cleaner']['misses'], 1)
+        self.assertEqual(stats['default_cleaner']['size'], 2)
+        self.assertIs(
+            self.cleaner.memoize(cleaners.float_cleaner),
+            self.cleaner.column_cleaners[u'heading_data1']
+        )
+
+    def test_date_parser(self):
+        """A column's dominant date format is learned from a sample."""
+        parser = cleaners.DateParser(sample_size=3)
+        values = [u'2/12/2012', u'12/1/2013', u'', u'1/31/2014 ']
+        for value in values:
+            self.assertEqual(parser(value), cleaners.date_cleaner(value))
+        self.assertEqual(parser.format, u'mdy')
+
+        # Values outside the format, or not real dates in it, still get
+        # exactly what ``date_cleaner`` would make of them.
+        for value in [
+            u'3/4/2015', u'13/02/2012', u'2/30/2012', u'2013-03-13',
+            u'1420095481', None, u'some string',
+        ]:
+            self.assertEqual(parser(value), cleaners.date_cleaner(value))
+
+        self.assertEqual(
+            cleaners.DateParser().infer([u'2013-03-13', u'2013-3-1', u'x']),
+            u'ymd'
+        )
+        self.assertEqual(
+            cleaners.DateParser().infer([u'2013-03-13', u'x', u'y']), None
+        )
+        self.assertEqual(self.cleaner.date_formats(), {'heading2': None})
+
+    def test_clean_columns(self):
+        """Columns are cleaned just as their values would be one by one."""
+        columns = {
+            u'heading1': [u'Not Available', u'x', u'Not Available'],
+            u'heading2': [u'2/12/2012', u'', u'2/12/2012'],
+            u'heading_data1': [u'1,123.45', u'n/a', None],
+            u'unknown': [u'Whatever', [u'un', u'hashable'], 1],
+        }
+        cleaned = self.cleaner.clean_columns(columns)
+        for column_name, values in columns.items():
+            self.assertEqual(
+                cleaned[column_name],
+                [self.cleaner.clean_value(v, column_name) for v in values]
+            )
+        self.assertEqual(
+            cleaners.clean_column([1, 1.0, u'1'], type),
+            [int, float, unicode]
+        )
+        self.assertEqual(cleaners.clean_column([1, 1.0], type), [int, float])
+        self.assertEqual(
+            cleaners.clean_column([True, 1], type), [bool, int]
+        )
+        self.assertEqual(
+            self.cleaner.clean_column([u'N/A', 'N/A'], u'heading1'),
+            [None, 'N/A']
+        )
+
+        arrays = self.cleaner.clean_columns(columns, arrays=True)
+        self.assertEqual(arrays[u'heading_data1'][0], 1123.45)
+        self.assertTrue(cleaners.numpy.isnan(arrays[u'heading_data1'][1]))
+        self.assertEqual(arrays[u'heading1'], cleaned[u'heading1'])
+
+        arrays = self.cleaner.clean_arrays(columns)
+        self.assertEqual(arrays[u'heading2'].dtype, 'datetime64[us]')
+        # numpy.isnat is new in 1.13, and NaT only stopped equalling
+        # itself in 1.16.
+        self.assertEqual(str(arrays[u'heading2'][1]), 'NaT')
+        self.assertEqual(list(arrays[u'heading1']), cleaned[u'heading1'])
+        self.assertEqual(arrays[u'unknown'][1], [u'un', u'hashable'])
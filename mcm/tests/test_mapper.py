@@ -3,10 +3,16 @@
 :license: see LICENSE for more details.
 """
 import copy
+import os
+import shutil
+import tempfile
 from unittest import TestCase
 
+from concurrent.futures import ThreadPoolExecutor
+
 from mcm import cleaners
 from mcm import mapper
+from mcm import utils
 from mcm.tests.utils import FakeModel
 
 
@@ -166,6 +172,97 @@ class TestMapper(TestCase):
 
         self.assertDictEqual(dyn_mapping, expected)
 
+    def test_build_column_mapping_w_workers(self):
+        """Matching across a process pool gives the same mapping."""
+        dyn_mapping = mapper.build_column_mapping(
+            self.raw_columns, self.dest_columns, workers=2
+        )
+
+        self.assertDictEqual(dyn_mapping, self.expected)
+
+    def test_build_column_mapping_w_executor(self):
+        """A module level executor is used, with callables run here."""
+        expected = copy.deepcopy(self.expected)
+        expected[u'Building ID'] = [u'custom_id_1', 27]
+
+        def get_mapping(raw, *args, **kwargs):
+            if raw == u'Building ID':
+                return [u'custom_id_1', 27]
+
+        executor = ThreadPoolExecutor(max_workers=2)
+        previous = mapper.set_mapping_executor(executor)
+        try:
+            dyn_mapping = mapper.build_column_mapping(
+                self.raw_columns,
+                self.dest_columns,
+                previous_mapping=get_mapping,
+                workers=2,
+            )
+        finally:
+            mapper.set_mapping_executor(previous)
+            executor.shutdown()
+
+        self.assertDictEqual(dyn_mapping, expected)
+
+    def test_build_column_mapping_w_store(self):
+        """Matches for the same raw and dest columns come from the store."""
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'mappings.db')
+        try:
+            store = mapper.MappingStore(path=path)
+            dyn_mapping = mapper.build_column_mapping(
+                self.raw_columns, self.dest_columns, thresh=50, store=store
+            )
+            expected = copy.deepcopy(self.expected)
+            expected[u'BBL'] = [None, 0]
+            self.assertDictEqual(dyn_mapping, expected)
+            store.close()
+
+            store = mapper.MappingStore(path=path)
+            previous = mapper.set_mapping_store(store)
+            try:
+                # The threshold is still applied to stored matches.
+                self.assertDictEqual(
+                    mapper.build_column_mapping(
+                        self.raw_columns, self.dest_columns
+                    ),
+                    self.expected
+                )
+                mapper.build_column_mapping(
+                    self.raw_columns[::-1], self.dest_columns
+                )
+            finally:
+                mapper.set_mapping_store(previous)
+            self.assertEqual(store.hits, 1)
+            self.assertEqual(store.misses, 1)
+
+            self.assertEqual(
+                store.invalidate(self.raw_columns, self.dest_columns), 1
+            )
+            self.assertEqual(store.get(self.raw_columns, self.dest_columns),
+                             None)
+            self.assertEqual(store.invalidate(dest_columns=['other']), 0)
+            self.assertEqual(store.invalidate(dest_columns=self.dest_columns),
+                             1)
+
+            # Spreadsheet headers may hold numbers.
+            raw_columns = [u'Name', 2014.0]
+            expected = mapper.build_column_mapping(
+                raw_columns, self.dest_columns
+            )
+            self.assertEqual(expected[u'Name'], [u'name', 100])
+            for i in range(2):
+                self.assertDictEqual(
+                    mapper.build_column_mapping(
+                        raw_columns, self.dest_columns, store=store
+                    ),
+                    expected
+                )
+            self.assertEqual(store.hits, 2)
+            store.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
     def test_map_w_apply_func(self):
         """Make sure that our ``apply_func`` is run against specified items."""
         fake_model_class = FakeModel
@@ -226,6 +323,29 @@ class TestMapper(TestCase):
 
         self.assertEqual(modified_model.property_id, 234235423.0)
 
+    def test_map_row_w_duck_typed_cleaner(self):
+        """Cleaners only need ``clean_value`` and their column lists."""
+        class ListCleaner(object):
+            float_columns = ['property_id']
+            date_columns = []
+
+            def clean_value(self, value, column_name):
+                if column_name in self.float_columns:
+                    return float(value)
+                return value
+
+        row = {u'Property Id': u'234', u'heading1': u'value1'}
+        plan = mapper.compile_mapping(
+            self.fake_mapping, FakeModel, cleaner=ListCleaner()
+        )
+        model = plan.map(row)
+        self.assertEqual(model.property_id, 234.0)
+        self.assertEqual(model.heading_1, u'value1')
+        self.assertEqual(
+            plan.map_columns(utils.rows_to_columns([row]))[0].__dict__,
+            model.__dict__
+        )
+
     def test_map_row_handle_unmapped_columns(self):
         """No KeyError when we check mappings for our column."""
         test_mapping = copy.deepcopy(self.fake_mapping)
@@ -413,3 +533,120 @@ class TestMapper(TestCase):
         sale_expected = u'01/23/2012'
         self.assertEqual(modified_model.address1, st_expected)
         self.assertEqual(modified_model.sale_date, sale_expected)
+
+    def test_compile_mapping(self):
+        """A compiled plan maps many rows just like ``map_row``."""
+        concat = {
+            'target': 'address_1',
+            'concat_columns': ['street number', 'street name'],
+        }
+        plan = mapper.compile_mapping(
+            self.fake_mapping,
+            FakeModel,
+            cleaner=self.test_cleaner,
+            concat=concat,
+        )
+        rows = [
+            {
+                u'Property Id': u'234,235,423',
+                u'street number': u'1232',
+                u'street name': u'Fanfare St.',
+                u'heading3': u'value3',
+            },
+            {
+                u'Property Id': u'1',
+                u'street name': u'Main St.',
+            },
+        ]
+
+        models = [plan.map(row) for row in rows]
+
+        self.assertEqual(models[0].property_id, 234235423.0)
+        self.assertEqual(models[0].address_1, u'1232 Fanfare St.')
+        self.assertEqual(models[0].extra_data[u'heading3'], u'value3')
+        self.assertEqual(models[1].property_id, 1.0)
+        # Concatenated values don't leak from one row into the next.
+        self.assertEqual(models[1].address_1, u'Main St.')
+        self.assertFalse(u'heading3' in models[1].extra_data)
+        # The caller's mapping is left alone.
+        self.assertFalse('address_1' in self.fake_mapping)
+
+    def test_map_columns(self):
+        """Mapping a batch held as columns gives the same models."""
+        concat = {
+            'target': 'address_1',
+            'concat_columns': ['street number', 'street name'],
+        }
+        rows = [
+            {
+                u'Property Id': u'234,235,423',
+                u'street number': u'1232',
+                u'street name': u'Fanfare St.',
+                u'heading3': u'value3',
+            },
+            {
+                u'Property Id': u'1',
+                u'street name': u'Main St.',
+                u'heading2': u'N/A',
+            },
+            {
+                u'Property Id': u'234,235,423',
+                u'street name': u'',
+            },
+        ]
+        plan = mapper.compile_mapping(
+            self.fake_mapping,
+            FakeModel,
+            cleaner=self.test_cleaner,
+            concat=concat,
+        )
+
+        by_column = plan.map_columns(utils.rows_to_columns(rows))
+        by_row = [plan.map(row) for row in rows]
+
+        self.assertEqual(len(by_column), 3)
+        for column_model, row_model in zip(by_column, by_row):
+            self.assertEqual(column_model.__dict__, row_model.__dict__)
+        self.assertEqual(by_column[1].address_1, u'Main St.')
+        self.assertEqual(plan.map_columns({}), [])
+
+    def test_map_batch_w_lookup(self):
+        """Existing models are looked up once per batch, by their key."""
+        existing = FakeModel()
+        existing.property_id = 1.0
+        existing.year_ending = u'2012'
+        lookups = []
+
+        def lookup(keys):
+            lookups.append(sorted(keys))
+            return [existing]
+
+        rows = [
+            {u'Property Id': u'1', u'Year Ending': u'2013'},
+            {u'Property Id': u'2', u'heading1': u'value1'},
+            {u'Property Id': u'2', u'heading2': u'value2'},
+            {u'Year Ending': u'2014'},
+        ]
+        plan = mapper.compile_mapping(
+            self.fake_mapping, FakeModel, cleaner=self.test_cleaner
+        )
+        models = plan.map_batch(rows, 'property_id', lookup)
+
+        self.assertEqual(lookups, [[1.0, 2.0]])
+        self.assertIs(models[0], existing)
+        self.assertEqual(existing.year_ending, u'2013')
+        # Rows with the same new key share a model; keyless rows don't.
+        self.assertIs(models[1], models[2])
+        self.assertEqual(models[2].heading_1, u'value1')
+        self.assertEqual(models[2].heading_2, u'value2')
+        self.assertFalse(models[3] in models[:3])
+
+        # Lookups may also give a dict of key -> model.
+        by_column = plan.map_columns(
+            utils.rows_to_columns(rows),
+            'property_id',
+            lambda keys: {1.0: existing},
+        )
+        self.assertIs(by_column[0], existing)
+        self.assertIs(by_column[1], by_column[2])
+        self.assertEqual(plan.row_key(rows[3], 'property_id'), None)
@@ -1,5 +1,10 @@
+import os
+import shutil
+import tempfile
 from unittest import TestCase
 
+import jellyfish
+
 from mcm import matchers
 
 
@@ -89,3 +94,159 @@ class TestMatchers(TestCase):
         self.assertEqual(first_match[0], 'illinois')
         self.assertGreater(first_match[1], 90)
         self.assertLess(second_match[1], 90)
+
+    def test_column_matcher_matches_full_scan(self):
+        """The index returns exactly what scoring every category would."""
+        matcher = matchers.ColumnMatcher(US_STATES)
+        for state in ['Ilinois', 'new yrok', 'Virginia', 'z', '']:
+            scores = sorted(
+                (jellyfish.jaro_winkler(state.upper(), cat.upper()), i)
+                for i, cat in enumerate(US_STATES)
+            )[-3:]
+            expected = [
+                (US_STATES[i], int(score * 100))
+                for score, i in reversed(scores)
+            ]
+            self.assertEqual(matcher.best_match(state, top_n=3), expected)
+
+    def test_column_matcher_ties_and_exact_matches(self):
+        """Ties favor the later category, as a stable sort of scores would."""
+        matcher = matchers.ColumnMatcher(['City', 'Town', 'CITY', 'city'])
+        self.assertEqual(
+            matcher.best_match('city', top_n=2),
+            [('city', 100), ('CITY', 100)]
+        )
+
+    def test_fuzzy_in_set(self):
+        """Only close enough matches count as being in the set."""
+        self.assertTrue(matchers.fuzzy_in_set('N/A', ['n/a', 'none']))
+        self.assertTrue(matchers.fuzzy_in_set('Ilinois', US_STATES))
+        self.assertFalse(
+            matchers.fuzzy_in_set('Ilinois', US_STATES, percent_confidence=96)
+        )
+
+    def test_get_matcher_reuses_index(self):
+        """Indexes are built once per set of categories."""
+        matcher = matchers.get_matcher(US_STATES)
+        self.assertIs(matchers.get_matcher(list(US_STATES)), matcher)
+        self.assertIs(matchers.get_matcher(matcher), matcher)
+
+    def test_best_matches(self):
+        """Batched matching agrees with matching one string at a time."""
+        states = ['Ilinois', 'new yrok', 'TEXAS', 'Virginia', '']
+        expected = [
+            matchers.best_match(state, US_STATES, top_n=3)
+            for state in states
+        ]
+        self.assertEqual(
+            matchers.best_matches(states, US_STATES, top_n=3), expected
+        )
+
+        # Without numpy we fall back to scoring each string with the index.
+        numpy = matchers.numpy
+        matchers.numpy = None
+        try:
+            matcher = matchers.ColumnMatcher(US_STATES)
+            self.assertEqual(matcher.best_matches(states, top_n=3), expected)
+        finally:
+            matchers.numpy = numpy
+
+    def test_synonym_set(self):
+        """Staged membership agrees with ``fuzzy_in_set``."""
+        synonyms = [u'not available', u'not applicable', u'n/a']
+        nulls = matchers.SynonymSet(synonyms)
+        for value in [
+            u'n/a', u'N/A', u'not availble', u'not applicable', u'na',
+            u'123.4', u'', u'not available at all', u'Chicago',
+        ]:
+            self.assertEqual(
+                value in nulls, matchers.fuzzy_in_set(value, synonyms)
+            )
+            # And again, from the memo.
+            self.assertEqual(
+                value in nulls, matchers.fuzzy_in_set(value, synonyms)
+            )
+
+        strict = matchers.SynonymSet(synonyms, percent_confidence=100)
+        self.assertFalse(u'n/a' in strict)
+
+
+class TestMatchCache(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'matches.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_hits_and_misses(self):
+        """Repeat lookups, even with different case, come from the cache."""
+        cache = matchers.MatchCache()
+        matcher = matchers.ColumnMatcher(US_STATES, cache=cache)
+        expected = matcher.best_match('Ilinois', top_n=2)
+        self.assertEqual(matcher.best_match('ILINOIS', top_n=2), expected)
+        self.assertEqual(
+            matcher.best_matches(['ilinois'], top_n=2), [expected]
+        )
+        self.assertEqual(
+            cache.stats(),
+            {'hits': 2, 'misses': 1, 'size': 1, 'hit_rate': 2 / 3.0}
+        )
+
+        # A different top_n or set of categories is a different result.
+        matcher.best_match('Ilinois', top_n=1)
+        matchers.ColumnMatcher(US_STATES[1:], cache=cache).best_match(
+            'Ilinois', top_n=2
+        )
+        self.assertEqual(cache.misses, 3)
+
+    def test_lru_eviction(self):
+        """We only keep the most recently used results in memory."""
+        cache = matchers.MatchCache(max_size=2)
+        matcher = matchers.ColumnMatcher(US_STATES, cache=cache)
+        matcher.best_match('ohio')
+        matcher.best_match('iowa')
+        matcher.best_match('ohio')
+        matcher.best_match('utah')
+        self.assertEqual(len(cache), 2)
+        matcher.best_match('ohio')
+        self.assertEqual(cache.hits, 2)
+        matcher.best_match('iowa')
+        self.assertEqual(cache.misses, 4)
+
+    def test_persistence(self):
+        """Results stored on disk survive a new cache instance."""
+        cache = matchers.MatchCache(path=self.path)
+        expected = matchers.ColumnMatcher(US_STATES, cache=cache).best_match(
+            'Ilinois', top_n=3
+        )
+        cache.close()
+
+        cache = matchers.MatchCache(path=self.path)
+        matcher = matchers.ColumnMatcher(US_STATES, cache=cache)
+        self.assertEqual(matcher.best_match('Ilinois', top_n=3), expected)
+        self.assertEqual(cache.hits, 1)
+
+        cache.clear()
+        matcher.best_match('Ilinois', top_n=3)
+        self.assertEqual(cache.stats()['misses'], 1)
+        cache.close()
+
+    def test_module_cache(self):
+        """``set_match_cache`` turns caching on for the module functions."""
+        cache = matchers.MatchCache()
+        previous = matchers.set_match_cache(cache)
+        try:
+            matchers.best_match('Ilinois', US_STATES)
+            matchers.best_match('Ilinois', US_STATES)
+            self.assertTrue(matchers.fuzzy_in_set('Ilinois', US_STATES, 90))
+            # Synonym checks never touch it.
+            cache.peek = cache.get = None
+            nulls = matchers.SynonymSet([u'not available', u'n/a'])
+            self.assertTrue(u'not availble' in nulls)
+            self.assertFalse(u'not a number' in nulls)
+        finally:
+            matchers.set_match_cache(previous)
+
+        self.assertEqual(cache.hits, 1)
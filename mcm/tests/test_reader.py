@@ -2,11 +2,23 @@
 :copyright: (c) 2014 Building Energy Inc
 :license: see LICENSE for more details.
 """
+import bz2
+import codecs
+import csv
+import datetime
+import gzip
+import hashlib
+import io
+import pickle
+import threading
+import zipfile
 from unittest import TestCase
 
+from concurrent.futures import ThreadPoolExecutor
 import unicodecsv
 
-from mcm import reader
+from mcm import cleaners, compressed, formats, reader
+from mcm.utils import columns_to_rows, pipeline
 from mcm.tests import utils
 
 
@@ -50,6 +62,339 @@ class TestCSVParser(TestCase):
             escape, self.parser.csvreader.unicode_fieldnames
         ))
 
+    def test_sniff_dialect(self):
+        """Plain CSV skips sniffing, and dialects are remembered."""
+        wide = 'a,"{0}"\r\n'.format('x' * reader.SNIFF_BYTES)
+        self.parser.csvfile = io.BytesIO('Id,Name\r\n' + wide * 2)
+        self.parser.csvfile.readline()
+        self.assertEqual(self.parser._sample_rows(), [wide])
+        self.assertIs(self.parser._sniff_dialect(), csv.excel)
+        self.assertEqual(self.parser.csvfile.tell(), 0)
+
+        header = 'Id;Name;Area\r\n'
+        self.parser.csvfile = io.BytesIO(header + '1;a;1,5\r\n2;b;3\r\n')
+        self.assertEqual(self.parser._sniff_dialect().delimiter, ';')
+        key = hashlib.sha1(header).digest()
+        self.assertEqual(reader._dialects[key].delimiter, ';')
+
+        # The same header again isn't sniffed at all.
+        self.parser.csvfile = io.BytesIO(header + 'not much like CSV')
+        self.assertEqual(self.parser._sniff_dialect().delimiter, ';')
+
+
+class TestFastCSVParser(TestCase):
+    def setUp(self):
+        self.csv_f = open('test_data/test_espm.csv', 'rb')
+        self.parser = reader.MCMParser(self.csv_f, engine='fast')
+
+    def tearDown(self):
+        self.csv_f.close()
+
+    def test_same_rows(self):
+        """The fast engine reads just what the default one does."""
+        self.assertTrue(isinstance(self.parser.reader, reader.FastCSVParser))
+        rows = list(self.parser.next())
+        self.assertTrue(isinstance(rows[0], reader.CSVRow))
+        with open('test_data/test_espm.csv', 'rb') as f:
+            default = reader.MCMParser(f)
+            self.assertEqual(rows, list(default.next()))
+            self.assertEqual(self.parser.headers(), default.headers())
+            self.assertEqual(
+                self.parser.num_columns(), default.num_columns()
+            )
+        self.parser.seek_to_beginning()
+        self.assertEqual(list(self.parser.next()), rows)
+        # e.g. to send to a process pool
+        self.assertEqual(pickle.loads(pickle.dumps(rows, 2)), rows)
+
+    def test_tuples(self):
+        """Rows can be had as tuples, looked up through the header."""
+        fast = self.parser.reader
+        values = list(fast.tuples())[0]
+        self.assertEqual(values[fast.header_index[u'Property Id']], u'1')
+
+    def test_irregular_rows(self):
+        """Short and long rows, repeated names and bad bytes are all read
+        as ``DictReader`` reads them."""
+        data = (
+            'Id,Name,Id,Area ft\xc2\xb2\r\n'
+            '1,a,2,3\r\n4,b\r\n\r\n5,\xff,6,7,8,9\r\n'
+            '"1,2","x\r\ny",3,4\r\n'
+        )
+        default = reader.CSVParser(io.BytesIO(data))
+        fast = reader.FastCSVParser(io.BytesIO(data))
+        rows = list(fast.next())
+        self.assertEqual(rows, list(default.next()))
+        self.assertEqual(rows[1][u'Area ft2'], None)
+        self.assertEqual(rows[2][None], [u'8', u'9'])
+        self.assertEqual(rows[2][u'Name'], u'\ufffd')
+        self.assertEqual(rows[3][u'Id'], u'3')
+
+
+class TestMappedCSVParser(TestCase):
+    def setUp(self):
+        self.csv_f = open('test_data/test_espm.csv', 'rb')
+        self.parser = reader.MCMParser(self.csv_f, engine='mmap')
+        self.rows = list(self.parser.next())
+
+    def tearDown(self):
+        self.csv_f.close()
+
+    def test_same_rows(self):
+        """The mmap engine reads just what the default one does."""
+        self.assertTrue(isinstance(self.parser.reader, reader.MappedCSVParser))
+        with open('test_data/test_espm.csv', 'rb') as f:
+            self.assertEqual(self.rows, list(reader.MCMParser(f).next()))
+        self.parser.seek_to_beginning()
+        self.assertEqual(list(self.parser.next()), self.rows)
+
+    def test_for_rows(self):
+        """Readers over ranges of rows are independent of each other."""
+        mapped = self.parser.reader
+        self.assertEqual(mapped.num_rows(), len(self.rows))
+        first = self.parser.for_rows(0, 2).next()
+        rest = self.parser.for_rows(2).next()
+        self.assertEqual(next(rest), self.rows[2])
+        self.assertEqual(list(first), self.rows[:2])
+        self.assertEqual(list(rest), self.rows[3:])
+        self.assertEqual(list(mapped.for_rows(1, 3).for_rows(1).next()),
+                         self.rows[2:3])
+
+        # Other processes can open their share of the file by byte range.
+        chunks = []
+        for byte_range in mapped.byte_ranges(2):
+            with open('test_data/test_espm.csv', 'rb') as f:
+                parser = reader.MCMParser(
+                    f, engine='mmap', byte_range=byte_range
+                )
+                chunks.extend(parser.next())
+        self.assertEqual(chunks, self.rows)
+
+    def test_quoted_newlines(self):
+        """Rows are found by the csv module, so newlines in quotes and
+        blank lines don't throw the index off."""
+        data = (
+            'Id,Notes\r\n1,"a\r\n2,b"\r\n\r\n3,"c ""\n"" d"\n4,e\n'
+        )
+        mapped = reader.MappedCSVParser(io.BytesIO(data))
+        rows = list(mapped.next())
+        self.assertEqual(rows, list(reader.CSVParser(io.BytesIO(data)).next()))
+        self.assertEqual(mapped.num_rows(), 3)
+        self.assertEqual(list(mapped.for_rows(1, 2).next()), rows[1:2])
+        self.assertEqual(mapped.byte_range(2), (len(data) - 4, len(data)))
+
+
+class TestCSVStreamParser(TestCase):
+    def setUp(self):
+        with open('test_data/test_espm.csv', 'rb') as f:
+            self.data = f.read()
+            f.seek(0)
+            self.rows = list(reader.FastCSVParser(f).next())
+
+    def chunks(self, size):
+        for start in range(0, len(self.data), size):
+            yield self.data[start:start + size]
+
+    def test_pull(self):
+        """Rows are read from an iterable of chunks, however they split."""
+        for size in [1, 7, 4096]:
+            parser = reader.MCMParser(self.chunks(size), engine='stream')
+            self.assertEqual(parser.headers()[0], 'Property Id')
+            self.assertEqual(list(parser.next()), self.rows)
+        self.assertRaises(IOError, parser.seek_to_beginning)
+
+    def test_push(self):
+        """Fed chunks give back the rows they complete."""
+        parser = reader.CSVStreamParser()
+        data = 'Id,Notes\r\n1,"a\r\n'
+        self.assertEqual(parser.feed(data), [])
+        self.assertEqual(parser.headers(), [u'Id', u'Notes'])
+        rows = parser.feed('b"\r\n\r\n2,')
+        self.assertEqual(rows, [{u'Id': u'1', u'Notes': u'a\r\nb'}])
+        self.assertEqual(parser.feed('c'), [])
+        self.assertEqual(parser.close(), [{u'Id': u'2', u'Notes': u'c'}])
+
+    def test_short_streams(self):
+        """Streams ending in or before the header still have headers."""
+        parser = reader.CSVStreamParser(['Id,', 'Name'])
+        self.assertEqual(parser.headers(), [u'Id', u'Name'])
+        self.assertEqual(parser.num_columns(), 2)
+        self.assertEqual(list(parser.next()), [])
+
+        parser = reader.MCMParser(iter([]), engine='stream')
+        self.assertEqual(parser.headers(), [])
+        self.assertEqual(parser.num_columns(), 0)
+        self.assertEqual(list(parser.next()), [])
+
+
+class TestDetectFormat(TestCase):
+    def test_detect_format(self):
+        """Files are told apart by their leading bytes, and left as found."""
+        for name, expected in [
+            ('test_espm.csv', 'csv'),
+            ('test_espm.xls', 'xls'),
+            ('test_espm.xlsx', 'xlsx'),
+        ]:
+            with open('test_data/' + name, 'rb') as f:
+                self.assertEqual(formats.detect_format(f), expected)
+                self.assertEqual(f.tell(), 0)
+
+        for data, expected in [
+            ('PK\x03\x04 not a workbook', 'zip'),
+            ('\x1f\x8b\x08\x00', 'gzip'),
+            ('BZh91AY&SY', 'bz2'),
+            ('BZh,Name\r\n', 'csv'),
+            ('BZh', 'csv'),
+            ('\xff\xfeI\x00d\x00', 'utf-16'),
+            ('\xef\xbb\xbfId,Name\r\n', 'utf-8-sig'),
+        ]:
+            self.assertEqual(formats.detect_format(io.BytesIO(data)), expected)
+
+    def test_format_readers(self):
+        """Formats without a reader can't be parsed; new ones can be added."""
+        formats.register_format('pipes', lambda head, f: '|' in head, True)
+        try:
+            with self.assertRaises(Exception) as error:
+                reader.MCMParser(io.BytesIO('Id|Name\r\n'))
+            self.assertEqual(
+                error.exception.message, 'Cannot parse pipes files'
+            )
+            reader.FORMAT_READERS['pipes'] = lambda f, **kwargs: 'pipes reader'
+            parser = reader.MCMParser(io.BytesIO('Id|Name\r\n'))
+            self.assertEqual(parser.reader, 'pipes reader')
+        finally:
+            formats._signatures.pop(0)
+            reader.FORMAT_READERS.pop('pipes', None)
+
+    def test_byte_order_marks(self):
+        """Text with byte order marks is read as UTF-8, without them."""
+        with open('test_data/test_espm.csv', 'rb') as f:
+            data = f.read()
+            f.seek(0)
+            parser = reader.MCMParser(f)
+            headers, rows = parser.headers(), list(parser.next())
+
+        text = data.decode('utf-8')
+        for encoded in [
+            codecs.BOM_UTF8 + data,
+            text.encode('utf-16'),
+            codecs.BOM_UTF16_BE + text.encode('utf-16-be'),
+        ]:
+            parser = reader.MCMParser(io.BytesIO(encoded))
+            self.assertEqual(parser.headers(), headers)
+            self.assertEqual(list(parser.next()), rows)
+            parser.seek_to_beginning()
+            self.assertEqual(len(list(parser.next())), len(rows))
+
+
+class TestCompressedFiles(TestCase):
+    def setUp(self):
+        with open('test_data/test_espm.csv', 'rb') as f:
+            self.csv_data = f.read()
+            f.seek(0)
+            self.rows = list(reader.MCMParser(f).next())
+        with open('test_data/test_espm.xlsx', 'rb') as f:
+            self.xlsx_data = f.read()
+
+    def gzip(self, data):
+        f = io.BytesIO()
+        with gzip.GzipFile(fileobj=f, mode='wb') as gzip_file:
+            gzip_file.write(data)
+        return f.getvalue()
+
+    def test_gzip_and_bz2(self):
+        """Compressed files are read as they're decompressed."""
+        half = len(self.csv_data) // 2
+        for data in [
+            self.gzip(self.csv_data),
+            # Several streams, one after another.
+            self.gzip(self.csv_data[:half]) + self.gzip(self.csv_data[half:]),
+            bz2.compress(self.csv_data),
+        ]:
+            for engine in ['default', 'fast']:
+                parser = reader.MCMParser(io.BytesIO(data), engine=engine)
+                self.assertEqual(list(parser.next()), self.rows)
+                parser.seek_to_beginning()
+                self.assertEqual(list(parser.next()), self.rows)
+
+        parser = reader.MCMParser(io.BytesIO(self.gzip(self.xlsx_data)))
+        self.assertTrue(isinstance(parser.reader, reader.XLSXParser))
+
+    def test_zip_members(self):
+        """Each file in a zip archive can be read, straight out of it."""
+        data = io.BytesIO()
+        with zipfile.ZipFile(data, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            zip_file.writestr('exports/', '')
+            zip_file.writestr('exports/a.csv', self.csv_data)
+            zip_file.writestr('exports/b.xlsx', self.xlsx_data)
+
+        parser = reader.MCMParser(data, engine='fast')
+        self.assertEqual(
+            parser.member_names(), ['exports/a.csv', 'exports/b.xlsx']
+        )
+        self.assertEqual(list(parser.next()), self.rows)
+        parser.seek_to_beginning()
+        self.assertEqual(list(parser.next()), self.rows)
+
+        members = list(parser.members())
+        self.assertEqual(members[1].reader_kwargs['member'], 'exports/b.xlsx')
+        self.assertTrue(isinstance(members[1].reader, reader.XLSXParser))
+        self.assertEqual(len(list(members[1].next())), 3)
+        self.assertEqual(list(members[0].next()), self.rows)
+
+    def test_stream_file(self):
+        """Stream files read and seek like files, going back by reopening."""
+        opened = []
+
+        def open_stream():
+            opened.append(1)
+            return io.BytesIO('ab\ncd\nef')
+
+        chunk_size, compressed.CHUNK_SIZE = compressed.CHUNK_SIZE, 2
+        try:
+            f = compressed.StreamFile(open_stream)
+            self.assertEqual(list(f), ['ab\n', 'cd\n', 'ef'])
+            # Only the last chunk is kept, so this starts over.
+            f.seek(4)
+            self.assertEqual((f.read(3), f.tell()), ('d\ne', 7))
+            self.assertEqual(len(opened), 2)
+            f.seek(2, 1)
+            self.assertEqual(f.read(), '')
+            self.assertRaises(IOError, f.seek, 0, 2)
+        finally:
+            compressed.CHUNK_SIZE = chunk_size
+
+
+class TestFindHeaderRow(TestCase):
+    E, T, N = reader.XL_CELL_EMPTY, reader.XL_CELL_TEXT, reader.XL_CELL_NUMBER
+
+    def test_find_header_row(self):
+        """Headers are the filled in, textual rows near the top."""
+        title = ([self.T, self.E, self.E], [u'Portfolio', u'', u''])
+        numbers = ([self.N, self.N, self.N], [1.0, 2.0, 3.0])
+        header = ([self.T, self.T, self.E], [u'Property Id', u'Name', u''])
+        self.assertEqual(
+            reader.find_header_row([title, numbers, header], 3)[0], 2
+        )
+        self.assertEqual(reader.find_header_row([], 3), (0, None))
+
+        # Given an ontology, rows of its column names win.
+        notes = ([self.T, self.T, self.T], [u'a', u'b', u'c'])
+        header = ([self.T, self.T, self.T], [u'Property Id', u'x', u'y'])
+        names = reader._header_names({u'flat_schema': {u'property id': u''}})
+        self.assertEqual(reader.find_header_row([notes, header], 3)[0], 0)
+        self.assertEqual(
+            reader.find_header_row([notes, header], 3, names)[0], 1
+        )
+
+    def test_find_header_row_stops_early(self):
+        """Nothing after a row which can't be beaten is looked at."""
+        def rows():
+            yield [self.T, self.T], [u'Property Id', u'Name']
+            raise AssertionError('read too far')
+
+        self.assertEqual(reader.find_header_row(rows(), 2)[0], 0)
+
 
 class TestMCMParserCSV(TestCase):
     def setUp(self):
@@ -87,6 +432,18 @@ class TestMCMParserCSV(TestCase):
     def test_num_colums(self):
         self.assertEqual(self.parser.num_columns(), 250)
 
+    def test_column_batches(self):
+        """Batches of rows can be had as columns instead."""
+        rows = list(self.parser.next())
+        self.parser.seek_to_beginning()
+        batches = list(self.parser.column_batches(2))
+        self.assertEqual([len(b[u'Property Id']) for b in batches], [2, 1])
+        self.assertEqual(
+            columns_to_rows(batches[0])
+            + columns_to_rows(batches[1]),
+            rows
+        )
+
     def test_headers(self):
         """tests that we can get the original order of headers"""
         self.assertEqual(
@@ -98,6 +455,109 @@ class TestMCMParserCSV(TestCase):
             'Release Date'
         )
 
+    def test_iter_batches(self):
+        """Batches of columns come typed by the ontology."""
+        ontology = {'types': {
+            u'Site EUI (kBtu/ft2)': u'float',
+            u'Release Date': u'date',
+        }}
+        batches = list(self.parser.iter_batches(2, ontology))
+        self.assertEqual([len(b[u'Property Id']) for b in batches], [2, 1])
+        eui = batches[0][u'Site EUI (kBtu/ft2)']
+        self.assertEqual(eui.dtype, 'float64')
+        self.assertEqual(list(eui), [56.9, 29.8])
+        self.assertEqual(
+            batches[1][u'Release Date'][0],
+            cleaners.numpy.datetime64(
+                datetime.datetime(2013, 9, 27, 11, 42), 'us'
+            )
+        )
+        self.assertEqual(list(batches[1][u'Property Id']), [u'3'])
+
+        # The fast engine pivots its rows' tuples straight into columns.
+        with open('test_data/test_espm.csv', 'rb') as f:
+            fast = reader.MCMParser(f, engine='fast')
+            self.parser.seek_to_beginning()
+            self.assertEqual(
+                list(fast.column_batches(2)),
+                list(self.parser.column_batches(2))
+            )
+
+    def test_process_rows(self):
+        """Batches are processed on the executor, errors and all."""
+        def callback(rows):
+            if rows[0][u'Property Id'] == u'1':
+                raise ValueError('bad batch')
+            return [row[u'Property Id'] for row in rows]
+
+        with ThreadPoolExecutor(2) as executor:
+            done = self.parser.process_rows(
+                2, callback, executor, max_in_flight=1
+            )
+        self.assertEqual(done.rows, 3)
+        self.assertEqual([batch.index for batch in done], [0, 1])
+        self.assertEqual(done.results, [[u'3']])
+        self.assertEqual(done.errors[0].index, 0)
+        self.assertRaises(ValueError, done.raise_errors)
+
+        self.parser.seek_to_beginning()
+        done = self.parser.process_rows(1, len, ordered=False)
+        self.assertEqual(done.results, [1, 1, 1])
+
+    def test_pipeline_backpressure(self):
+        """Batches aren't read faster than they're processed."""
+        read = []
+        release = threading.Event()
+
+        def batches():
+            for i in range(6):
+                read.append(i)
+                yield [i]
+
+        def wait(batch):
+            release.wait()
+            return batch[0]
+
+        with ThreadPoolExecutor(2) as executor:
+            results = pipeline(
+                batches(), wait, executor, max_in_flight=3, ordered=False
+            )
+            threading.Timer(0.1, release.set).start()
+            first = next(results)
+            # Three in flight, and the one waiting for room.
+            self.assertTrue(len(read) <= 4)
+            rest = list(results)
+        self.assertEqual(
+            sorted(batch.result for batch in [first] + rest), range(6)
+        )
+
+    def test_map_rows_w_lookup(self):
+        """Existing models are found for map_rows a batch at a time."""
+        existing = utils.FakeModel()
+        existing.property_id = u'2'
+        lookups = []
+
+        def lookup(keys):
+            lookups.append(sorted(keys))
+            return [existing]
+
+        mapping = {
+            u'Property Id': u'property_id',
+            u'Property Name': u'property_name',
+        }
+        models = list(self.parser.map_rows(
+            mapping,
+            utils.FakeModel,
+            key='property_id',
+            lookup=lookup,
+            lookup_size=2,
+        ))
+        self.assertEqual(lookups, [[u'1', u'2'], [u'3']])
+        self.assertEqual(len(models), 3)
+        self.assertIs(models[1], existing)
+        self.assertEqual(existing.property_name, u'Database2')
+        self.assertEqual(models[2].property_id, u'3')
+
 
 class TestMCMParserXLS(TestCase):
     def setUp(self):
@@ -145,11 +605,33 @@ class TestMCMParserXLS(TestCase):
             'Release Date'
         )
 
+    def test_convert_row(self):
+        """Whole rows convert just as their cells do one by one."""
+        excel_parser = self.parser.reader
+        sheet = excel_parser.sheet
+        for i in range(sheet.nrows):
+            self.assertEqual(
+                excel_parser.convert_row(
+                    sheet.row_types(i), sheet.row_values(i)
+                ),
+                [excel_parser.get_value(cell) for cell in sheet.row(i)]
+            )
+        row = list(self.parser.next())[0]
+        self.assertEqual(row['Property Id'], 5487)
+        self.assertEqual(
+            row['Release Date'], datetime.datetime(2013, 4, 1, 4, 22)
+        )
+
     def test_blank_row(self):
         self.xls_f.close()
         self.xls_f = open('test_data/test_espm_blank_rows.xls', 'rb')
         self.parser = reader.MCMParser(self.xls_f)
         self.total_callbacks = 0
+        self.assertEqual(self.parser.reader.header_row, 4)
+        # Too few rows considered to reach it, we make do with the title.
+        self.assertEqual(
+            reader.MCMParser(self.xls_f, header_rows=3).reader.header_row, 0
+        )
         self.assertEqual(
             self.parser.headers()[0],
             'Property Id'
@@ -230,3 +712,95 @@ class TestMCMParserXLSX(TestCase):
         )
         # this is the bad date value cell
         self.assertEqual(row['Date Collected'], None)
+
+    def test_streams_xlsx(self):
+        """xlsx files are streamed, giving the same rows as xlrd would."""
+        self.assertTrue(isinstance(self.parser.reader, reader.XLSXParser))
+        rows = list(self.parser.next())
+        with open('test_data/test_espm.xlsx', 'rb') as f:
+            excel_parser = reader.ExcelParser(f)
+            self.assertEqual(rows, list(excel_parser.next()))
+            self.assertEqual(self.parser.headers(), excel_parser.headers())
+        self.parser.seek_to_beginning()
+        self.assertEqual(list(self.parser.next()), rows)
+
+    def test_xlsx_wrong_dimension(self):
+        """Columns are counted from cells, not the sheet's <dimension>."""
+        for ref in ['A1:B4', 'A1:IZ4']:
+            xlsx_f = io.BytesIO()
+            with zipfile.ZipFile('test_data/test_espm.xlsx') as source:
+                with zipfile.ZipFile(xlsx_f, 'w') as copy:
+                    for name in source.namelist():
+                        data = source.read(name)
+                        if name == 'xl/worksheets/sheet1.xml':
+                            data = data.replace(
+                                '<dimension ref="A1:IP4"/>',
+                                '<dimension ref="{0}"/>'.format(ref)
+                            )
+                        copy.writestr(name, data)
+
+            parser = reader.XLSXParser(xlsx_f)
+            excel_parser = reader.ExcelParser(xlsx_f)
+            self.assertEqual(parser.num_columns(), 250)
+            self.assertEqual(parser.headers(), excel_parser.headers())
+            self.assertEqual(list(parser.next()), list(excel_parser.next()))
+
+
+def sheet_property_ids(sheet):
+    """Used to check process_sheets; module level so it pickles."""
+    return [row['Property Id'] for row in sheet.next()]
+
+
+class TestMCMParserSheets(TestCase):
+    def setUp(self):
+        # Written with xlwt 1.3.0: sheets 'Building A', 'Building B' (whose
+        # header is its second row, under a note) and 'Building C', with
+        # 'Property Id' values 1-2, 3 and 4-6.
+        self.xls_f = open('test_data/test_multi_sheet.xls', 'rb')
+        self.parser = reader.MCMParser(self.xls_f)
+
+    def tearDown(self):
+        self.xls_f.close()
+
+    def test_sheets(self):
+        """Each sheet gets its own parser, loaded one at a time."""
+        self.assertEqual(
+            self.parser.sheet_names(),
+            [u'Building A', u'Building B', u'Building C']
+        )
+        book = self.parser.reader._workbook
+        ids = []
+        for i, sheet in enumerate(self.parser.sheets()):
+            self.assertTrue(book.sheet_loaded(i))
+            self.assertFalse(i and book.sheet_loaded(i - 1))
+            self.assertEqual(sheet.headers()[0], u'Property Id')
+            ids.append([row['Property Id'] for row in sheet.next()])
+        self.assertEqual(ids, [[1, 2], [3], [4, 5, 6]])
+
+        parser = reader.MCMParser(self.xls_f, sheet_index=1)
+        self.assertEqual(parser.reader.header_row, 1)
+
+    def test_process_sheets(self):
+        """Sheets can be processed concurrently, results kept in order."""
+        expected = [[1, 2], [3], [4, 5, 6]]
+        self.assertEqual(
+            self.parser.process_sheets(sheet_property_ids), expected
+        )
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            self.assertEqual(
+                self.parser.process_sheets(sheet_property_ids, executor),
+                expected
+            )
+
+    def test_csv_sheets(self):
+        """A CSV file is a single sheet."""
+        with open('test_data/test_espm.csv', 'rb') as f:
+            parser = reader.MCMParser(f)
+            self.assertEqual(list(parser.sheets()), [parser])
+            self.assertEqual(parser.sheet_names(), [])
+            self.assertEqual(
+                [len(ids) for ids in parser.process_sheets(
+                    sheet_property_ids, ThreadPoolExecutor(max_workers=1)
+                )],
+                [3]
+            )
@@ -0,0 +1,73 @@
+"""
+:copyright: (c) 2014 Building Energy Inc
+:license: see LICENSE for more details.
+"""
+import sqlite3
+from unittest import TestCase
+
+from mcm import reader, sinks
+from mcm.mappings import espm
+from mcm.tests.utils import FakeModel
+
+
+class TestSinks(TestCase):
+    def test_sink(self):
+        """Models are saved flush_size at a time, and on close."""
+        batches = []
+        sink = sinks.Sink(batches.append, flush_size=2)
+        with sink:
+            sink.extend(range(5))
+            self.assertEqual(batches, [[0, 1], [2, 3]])
+            self.assertEqual(len(sink), 1)
+
+        self.assertEqual(batches, [[0, 1], [2, 3], [4]])
+        stats = sink.stats()
+        self.assertEqual(stats['flushes'], 3)
+        self.assertEqual(stats['saved'], 5)
+        self.assertEqual(stats['buffered'], 0)
+        self.assertTrue(stats['max_seconds'] <= stats['seconds'])
+
+        # What's buffered when mapping fails isn't saved.
+        with self.assertRaises(ValueError):
+            with sinks.Sink(batches.append) as sink:
+                sink.add(5)
+                raise ValueError
+        self.assertEqual(len(batches), 3)
+
+    def test_sqlite_sink(self):
+        """Each flush is one transaction, replacing rows by key."""
+        db = sqlite3.connect(':memory:')
+        columns = sorted(set(espm.MAP.values())) + [u'extra_data']
+        sink = sinks.SQLiteSink(
+            db, u'buildings', columns, key=u'pm_property_id', flush_size=2
+        )
+        with open('test_data/test_espm.csv', 'rb') as f:
+            parser = reader.MCMParser(f)
+            stats = parser.save_rows(espm.MAP, FakeModel, sink)
+            parser.seek_to_beginning()
+            parser.save_rows(espm.MAP, FakeModel, sink)
+
+        self.assertEqual(stats['flushes'], 2)
+        self.assertEqual(stats['saved'], 3)
+        rows = db.execute(
+            'SELECT pm_property_id, property_name, extra_data FROM buildings'
+            ' ORDER BY pm_property_id'
+        ).fetchall()
+        self.assertEqual(
+            [row[:2] for row in rows],
+            [(u'1', u'Database1'), (u'2', u'Database2'), (u'3', u'Database3')]
+        )
+        self.assertTrue(u'"Property Notes": null' in rows[0][2])
+
+        # A failed batch leaves nothing of itself behind, and stays
+        # buffered.
+        saved, unsaveable = FakeModel(), FakeModel()
+        saved.pm_property_id = u'4'
+        unsaveable.pm_property_id = u'5'
+        unsaveable.property_name = object()
+        with self.assertRaises(sqlite3.InterfaceError):
+            sink.extend([saved, unsaveable])
+        self.assertEqual(len(sink), 2)
+        self.assertEqual(
+            db.execute('SELECT COUNT(*) FROM buildings').fetchone(), (3,)
+        )
@@ -2,7 +2,12 @@
 :copyright: (c) 2014 Building Energy Inc
 :license: see LICENSE for more details.
 """
+from collections import OrderedDict
 import json
+import multiprocessing
+import sqlite3
+import threading
+from concurrent.futures import FIRST_COMPLETED, wait
 from dateutil import parser
 from itertools import islice, chain
 
@@ -21,6 +26,330 @@ def batch(iterable, size):
         yield list(chain([batchiter.next()], batchiter))
 
 
+class BatchResult(object):
+    """What came of calling a function on one batch, for ``pipeline``.
+
+    :param index: int, the batch's position among all batches, from 0.
+    :param size: int, how many items were in the batch.
+    :param result: what the function returned, or None if it raised.
+    :param error: the exception the function raised, or None.
+
+    """
+    def __init__(self, index, size, result=None, error=None):
+        self.index = index
+        self.size = size
+        self.result = result
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return 'BatchResult({0}, {1}, {2!r}, {3!r})'.format(
+            self.index, self.size, self.result, self.error
+        )
+
+
+class BatchResults(list):
+    """The ``BatchResult`` of each batch of a run, in the order they were
+    collected."""
+    @property
+    def rows(self):
+        """number of items in all the batches"""
+        return sum(batch.size for batch in self)
+
+    @property
+    def results(self):
+        """what each successful batch returned"""
+        return [batch.result for batch in self if batch.ok]
+
+    @property
+    def errors(self):
+        """the ``BatchResult`` of each batch that raised"""
+        return [batch for batch in self if not batch.ok]
+
+    def raise_errors(self):
+        """raises the first batch's error, if any did"""
+        for batch in self.errors:
+            raise batch.error
+
+
+def _collect(in_flight, ordered):
+    """Wait for the next of the futures in_flight to finish, or all that
+    have with ``ordered`` False, and take them out of in_flight.
+
+    :param in_flight: OrderedDict of future -> (batch index, batch size).
+    :rtype: list of ``BatchResult``.
+
+    """
+    if ordered:
+        done = [next(iter(in_flight))]
+    else:
+        finished = wait(in_flight, return_when=FIRST_COMPLETED).done
+        done = [future for future in in_flight if future in finished]
+
+    results = []
+    for future in done:
+        index, size = in_flight.pop(future)
+        error = future.exception()
+        result = None if error is not None else future.result()
+        results.append(BatchResult(index, size, result, error))
+    return results
+
+
+def pipeline(
+    batches, func, executor=None, max_in_flight=None, ordered=True
+):
+    """Generator calling ``func(batch)`` for each of batches on executor.
+
+    Batches are read here, in the calling thread, while the executor works
+    on earlier ones; no more than ``max_in_flight`` are handed over at once,
+    so a slow executor holds up reading rather than filling up memory.
+    An error in one batch doesn't stop the others.
+
+    Usage:
+            with ProcessPoolExecutor(4) as executor:
+                for done in pipeline(batch(rows, 100), save, executor):
+                    done.index, done.result, done.error
+
+    :param batches: iterable of lists, e.g. from ``batch``.
+    :param func: callable, called with each batch. For process pools it
+        must be picklable, e.g. a module level function.
+    :param executor: (optional) ``concurrent.futures`` style executor;
+        without one, batches are processed one after another right here.
+    :param max_in_flight: (optional) int, most batches submitted and not
+        yet collected; by default twice the number of CPUs.
+    :param ordered: (optional) bool, whether to give results in batch
+        order, or as soon as they're ready.
+    :rtype: Generator yielding a ``BatchResult`` per batch.
+
+    """
+    if executor is None:
+        for index, items in enumerate(batches):
+            try:
+                yield BatchResult(index, len(items), func(items))
+            except Exception as e:
+                yield BatchResult(index, len(items), error=e)
+        return
+
+    max_in_flight = max(1, max_in_flight or 2 * multiprocessing.cpu_count())
+    in_flight = OrderedDict()
+    for index, items in enumerate(batches):
+        while len(in_flight) >= max_in_flight:
+            for result in _collect(in_flight, ordered):
+                yield result
+        in_flight[executor.submit(func, items)] = (index, len(items))
+
+    while in_flight:
+        for result in _collect(in_flight, ordered):
+            yield result
+
+
+class SQLiteCache(object):
+    """LRU cache, optionally backed by a sqlite table.
+
+    The most recently used ``max_size`` entries are kept in memory; with a
+    ``path`` every entry is also written to a sqlite file, and survives
+    restarts. Subclasses name the table and its value columns, and turn
+    values into rows of them and back with ``_dump`` and ``_load``.
+    Usage:
+            class Results(SQLiteCache):
+                table = 'results'
+                columns = ('result',)
+
+            cache = Results(max_size=100, path='/tmp/results.db')
+            cache.set('key', ('result',))
+            cache.get('key')
+
+    """
+    # Name of the sqlite table, and its columns besides ``key``.
+    table = None
+    columns = ()
+
+    def __init__(self, max_size, path=None):
+        self.max_size = max_size
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            # Losing the last few writes on a crash only costs redoing them.
+            self._db.execute('PRAGMA synchronous = OFF')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS {0} '
+                '(key TEXT PRIMARY KEY, {1})'.format(
+                    self.table,
+                    ', '.join(column + ' TEXT' for column in self.columns)
+                )
+            )
+            self._db.commit()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _db_key(self, key):
+        """key as stored in the table."""
+        return key
+
+    def _dump(self, value):
+        """value as a row of ``columns``."""
+        return value
+
+    def _load(self, row):
+        """The value stored as row."""
+        return row
+
+    def _remember(self, key, value):
+        """Put value in memory as most recently used, evicting if full."""
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _lookup(self, key):
+        value = self._entries.get(key)
+        if value is not None:
+            self._remember(key, value)
+        elif self._db is not None:
+            row = self._db.execute(
+                'SELECT {0} FROM {1} WHERE key = ?'.format(
+                    ', '.join(self.columns), self.table
+                ),
+                (self._db_key(key),)
+            ).fetchone()
+            if row is not None:
+                value = self._load(row)
+                self._remember(key, value)
+
+        return value
+
+    def get(self, key):
+        """Return the value cached for key, or None; counts toward stats."""
+        with self._lock:
+            value = self._lookup(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return value
+
+    def peek(self, key):
+        """Like ``get``, without counting toward hits and misses."""
+        with self._lock:
+            return self._lookup(key)
+
+    def set(self, key, value):
+        """Cache value for key."""
+        with self._lock:
+            self._remember(key, value)
+            if self._db is not None:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO {0} (key, {1}) '
+                    'VALUES (?, {2})'.format(
+                        self.table,
+                        ', '.join(self.columns),
+                        ', '.join('?' for column in self.columns)
+                    ),
+                    (self._db_key(key),) + tuple(self._dump(value))
+                )
+                self._db.commit()
+
+    def _forget(self, test, where, args=()):
+        """Forget the entries test(key, value) is true of, and the rows the
+        sql condition where selects, given args.
+
+        :returns: int, how many were forgotten.
+
+        """
+        with self._lock:
+            keys = [
+                key for key, value in self._entries.items()
+                if test(key, value)
+            ]
+            for key in keys:
+                del self._entries[key]
+            forgotten = set(self._db_key(key) for key in keys)
+            if self._db is not None:
+                forgotten.update(row[0] for row in self._db.execute(
+                    'SELECT key FROM {0} WHERE {1}'.format(self.table, where),
+                    args
+                ))
+                self._db.execute(
+                    'DELETE FROM {0} WHERE {1}'.format(self.table, where),
+                    args
+                )
+                self._db.commit()
+
+        return len(forgotten)
+
+    def clear(self):
+        """Forget everything, on disk too, and reset the counters."""
+        self._forget(lambda key, value: True, '1')
+        self.hits = self.misses = 0
+
+    def close(self):
+        """Close the backing sqlite file, if there is one."""
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def stats(self):
+        """Hit and miss counts, with in memory size and hit rate."""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+        }
+
+
+def rows_to_columns(rows):
+    """Pivot a list of row dicts into a dict of columns.
+
+    Columns missing from some rows are filled in with None for them.
+    Usage:
+            rows_to_columns([{'a': 1, 'b': 2}, {'a': 3}])
+            # {'a': [1, 3], 'b': [2, None]}
+
+    :param rows: list of dict, column name -> value.
+    :rtype: dict, column name -> list of values, one per row.
+
+    """
+    columns = {}
+    for i, row in enumerate(rows):
+        for key, value in row.iteritems():
+            column = columns.get(key)
+            if column is None:
+                column = columns[key] = [None] * i
+            column.append(value)
+        for column in columns.itervalues():
+            if len(column) <= i:
+                column.append(None)
+
+    return columns
+
+
+def columns_to_rows(columns):
+    """Pivot a dict of columns, e.g. from ``rows_to_columns``, into rows.
+
+    :param columns: dict, column name -> list of values.
+    :rtype: list of dict, one per row.
+
+    """
+    names = list(columns)
+    return [
+        dict(zip(names, values))
+        for values in zip(*[columns[name] for name in names])
+    ]
+
+
 def date_str_to_date(date_str):
     if date_str:
         return parser.parse(date_str)
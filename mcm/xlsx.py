@@ -0,0 +1,301 @@
+"""
+:copyright: (c) 2014 Building Energy Inc
+:license: see LICENSE for more details.
+
+
+Streams rows out of .xlsx sheets.
+
+xlrd parses the whole of an .xlsx sheet into memory before giving any of it
+back. Here the sheet's XML is walked with ``iterparse`` instead, keeping a
+single row at a time, and shared strings are only read as far as the rows
+need them. The workbook and its styles are small, so xlrd reads those, and
+decides which cells are dates, just as it would for a whole workbook.
+
+"""
+import sys
+import zipfile
+
+from xlrd import Book, XLRDError
+from xlrd.sheet import Cell
+from xlrd.xlsx import (
+    U_SSML12,
+    X12Book,
+    X12Styles,
+    cell_name_to_rowx_colx,
+    cooked_text,
+    ensure_elementtree_imported,
+    error_code_from_text,
+    get_text_from_si_or_is,
+)
+
+try:
+    from xml.etree import cElementTree as ET
+except ImportError:  # pragma: no cover
+    from xml.etree import ElementTree as ET
+
+# from xlrd/biffh.py
+XL_CELL_TEXT = 1
+XL_CELL_NUMBER = 2
+XL_CELL_BOOLEAN = 4
+XL_CELL_ERROR = 5
+
+SHEET_DATA_TAG = U_SSML12 + 'sheetData'
+ROW_TAG = U_SSML12 + 'row'
+V_TAG = U_SSML12 + 'v'
+IS_TAG = U_SSML12 + 'is'
+SI_TAG = U_SSML12 + 'si'
+
+SHARED_STRINGS = 'xl/sharedStrings.xml'
+STYLES = 'xl/styles.xml'
+
+
+def is_xlsx(f):
+    """Is the open file f an .xlsx workbook? Leaves f at its start."""
+    f.seek(0)
+    try:
+        if not zipfile.is_zipfile(f):
+            return False
+        f.seek(0)
+        return 'xl/workbook.xml' in zipfile.ZipFile(f).namelist()
+    finally:
+        f.seek(0)
+
+
+class FileView(object):
+    """Reads f from a position of its own, so that several zip members
+    can be streamed out of one open file at once."""
+    def __init__(self, f):
+        self.f = f
+        self.pos = 0
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            self.pos = offset
+        elif whence == 1:
+            self.pos += offset
+        else:
+            self.f.seek(offset, whence)
+            self.pos = self.f.tell()
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        self.f.seek(self.pos)
+        data = self.f.read(size)
+        self.pos += len(data)
+        return data
+
+
+class SharedStrings(object):
+    """The workbook's shared strings, read from the file only as far as
+    the highest index asked for so far.
+
+    usage:
+            strings = SharedStrings(zf.open('xl/sharedStrings.xml'))
+            strings[3]  # parses the first four strings
+
+    """
+    def __init__(self, stream=None):
+        self._strings = []
+        self._events = iter(())
+        self._root = None
+        if stream is not None:
+            self._events = ET.iterparse(stream, events=('start', 'end'))
+
+    def __len__(self):
+        return len(self._strings)
+
+    def __getitem__(self, index):
+        strings = self._strings
+        while index >= len(strings):
+            try:
+                event, elem = next(self._events)
+            except StopIteration:
+                raise IndexError(index)
+            if self._root is None:
+                self._root = elem
+            elif event == 'end' and elem.tag == SI_TAG:
+                strings.append(get_text_from_si_or_is(self, elem))
+                # Drop the parsed string's elements.
+                self._root.clear()
+
+        return strings[index]
+
+
+def has_value(cell_elem):
+    """Would ``cell_value`` give a Cell for the <c> element?"""
+    if cell_elem.get('t', 'n') not in ('n', 's'):
+        return True
+    for child in cell_elem:
+        if child.tag == V_TAG and child.text:
+            return True
+
+    return False
+
+
+def cell_value(cell_elem, shared_strings, xf_types):
+    """The (ctype, value) xlrd would give a <c> element, as an xlrd Cell.
+
+    :returns: Cell, or None for cells xlrd leaves empty.
+
+    """
+    cell_type = cell_elem.get('t', 'n')
+    value = None
+    for child in cell_elem:
+        if child.tag == V_TAG:
+            value = child.text
+        elif child.tag == IS_TAG:
+            value = get_text_from_si_or_is(None, child)
+
+    if cell_type == 'n':
+        if not value:
+            return None
+        xf_index = int(cell_elem.get('s', '0'))
+        # Numbers are dates if their style's format says so.
+        return Cell(xf_types.get(xf_index, XL_CELL_NUMBER), float(value))
+    if cell_type == 's':
+        if not value:
+            return None
+        return Cell(XL_CELL_TEXT, shared_strings[int(value)])
+    if cell_type == 'str':
+        for child in cell_elem:
+            if child.tag == V_TAG:
+                value = cooked_text(None, child)
+        return Cell(XL_CELL_TEXT, value)
+    if cell_type == 'b':
+        return Cell(XL_CELL_BOOLEAN, int(value))
+    if cell_type == 'e':
+        return Cell(XL_CELL_ERROR, error_code_from_text[value])
+    if cell_type == 'inlineStr':
+        return Cell(XL_CELL_TEXT, value)
+
+    raise XLRDError('Unknown cell type {0!r}'.format(cell_type))
+
+
+class XLSXWorkbook(object):
+    """An .xlsx workbook whose sheets are read a row at a time.
+
+    usage:
+            book = XLSXWorkbook(open('data.xlsx', 'rb'))
+            for rowx, cells in book.iter_rows(0):
+                # cells is a dict of column index -> xlrd Cell
+            book.ncols(0)
+
+    """
+    def __init__(self, f):
+        self.f = f
+        self.zip_file = zipfile.ZipFile(FileView(f))
+        names = self.zip_file.namelist()
+        ensure_elementtree_imported(0, sys.stdout)
+        self.book = Book()
+        self.book.logfile = sys.stdout
+        self.book.verbosity = 0
+        self.book.formatting_info = 0
+        self.book.on_demand = True
+        self.book.ragged_rows = 0
+        x12book = X12Book(self.book)
+        x12book.process_rels(self.zip_file.open('xl/_rels/workbook.xml.rels'))
+        x12book.process_stream(self.zip_file.open('xl/workbook.xml'))
+        self.sheet_targets = x12book.sheet_targets
+        styles = X12Styles(self.book)
+        if STYLES in names:
+            styles.process_stream(self.zip_file.open(STYLES))
+        self.xf_types = self.book._xf_index_to_xl_type_map
+        # Shared by every pass over every sheet, as it only ever grows.
+        self.shared_strings = SharedStrings(
+            self._open(SHARED_STRINGS) if SHARED_STRINGS in names else None
+        )
+
+    @property
+    def datemode(self):
+        return self.book.datemode
+
+    @property
+    def nsheets(self):
+        return len(self.sheet_targets)
+
+    def sheet_names(self):
+        return self.book.sheet_names()
+
+    def _open(self, name):
+        """Stream the member name, independently of any others."""
+        return zipfile.ZipFile(FileView(self.f)).open(name)
+
+    def _events(self, sheet_index):
+        stream = self._open(self.sheet_targets[sheet_index])
+        return ET.iterparse(stream, events=('start', 'end'))
+
+    def ncols(self, sheet_index=0):
+        """Number of columns in the sheet, as xlrd would count them.
+
+        That's one past the last cell holding a value, found by a pass over
+        the sheet's cells. The sheet's <dimension> can't be trusted for it,
+        as writers leave it stale, or count formatted but empty cells.
+
+        """
+        ncols = 0
+        sheet_data = None
+        for event, elem in self._events(sheet_index):
+            if event == 'start':
+                if elem.tag == SHEET_DATA_TAG:
+                    sheet_data = elem
+                continue
+            if elem.tag != ROW_TAG:
+                continue
+
+            colx = -1
+            for cell_elem in elem:
+                cell_name = cell_elem.get('r')
+                if cell_name is None:
+                    colx += 1
+                else:
+                    colx = cell_name_to_rowx_colx(
+                        cell_name.replace('$', '')
+                    )[1]
+                if colx >= ncols and has_value(cell_elem):
+                    ncols = colx + 1
+
+            sheet_data.clear()
+
+        return ncols
+
+    def iter_rows(self, sheet_index=0):
+        """Generator yielding (row index, cells) for rows with any values.
+
+        :param sheet_index: int, the sheet with a 0-index.
+        :returns: Generator yielding (int, dict of column index -> Cell).
+
+        """
+        shared_strings = self.shared_strings
+        xf_types = self.xf_types
+        sheet_data = None
+        rowx = -1
+        for event, elem in self._events(sheet_index):
+            if event == 'start':
+                if elem.tag == SHEET_DATA_TAG:
+                    sheet_data = elem
+                continue
+            if elem.tag != ROW_TAG:
+                continue
+
+            row_number = elem.get('r')
+            rowx = rowx + 1 if row_number is None else int(row_number) - 1
+            cells = {}
+            colx = -1
+            for cell_elem in elem:
+                cell_name = cell_elem.get('r')
+                if cell_name is None:
+                    colx += 1
+                else:
+                    colx = cell_name_to_rowx_colx(
+                        cell_name.replace('$', '')
+                    )[1]
+                cell = cell_value(cell_elem, shared_strings, xf_types)
+                if cell is not None:
+                    cells[colx] = cell
+
+            # Only the row being read is ever kept in memory.
+            sheet_data.clear()
+            if cells:
+                yield rowx, cells
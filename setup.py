@@ -19,12 +19,17 @@ setup(
     include_package_data=True,
     package_data={'': ['README.md']},
     install_requires=[
+        'futures',
         'nose',
         'python-dateutil',
         'unicodecsv',
         'xlrd>=0.9.3',
         'jellyfish==0.4.0',
     ],
+    extras_require={
+        # Enables batched, vectorized column matching.
+        'numpy': ['numpy'],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Environment :: Web Environment',